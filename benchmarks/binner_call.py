@@ -25,3 +25,8 @@ f(img.flatten(), statistic=np.max)
 # median
 # standard .255
 # numba .2
+
+# fused binned_statistics (2048x2048)
+# mean .058 + median .189 + std .112 separately
+# fused mean/median/std .139
+# fused with percentiles (one sort per ring) .383
@@ -20,3 +20,6 @@ for i in range(10):
     binner = total(geo, img.shape)
 # 8.453 for 10 calls of generate_binner and generate_map_bin
 # 6.548 for 10 calls of generate_map_bin
+# with the on disk geometry cache warm (memory mapped loads)
+# .005 for the first and .001 for later calls of generate_map_bin
+# .002 for generate_binner (bin assignment and sort order loaded)
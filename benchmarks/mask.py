@@ -1,5 +1,5 @@
 from tifffile import imread
-from xpdtools.tools import binned_outlier, map_to_binner
+from xpdtools.tools import binned_outlier, generate_binner
 from profilehooks import profile
 import pyFAI
 
@@ -9,17 +9,18 @@ img = imread("test.tiff")
 bo = profile(binned_outlier, skip=1)
 # bo = binned_outlier
 
-binner = map_to_binner(geo, img.shape)
+binner = generate_binner(geo, img.shape)
 a = binner.argsort_index
 b = binner.flatcount
 
-for i in range(2):
-    bo(
-        img,
-        binner,
-        # bs_width=None,
-        mask_method="mean",
-    )
+for mask_method in ["mean", "median", "segmented_median"]:
+    for i in range(2):
+        bo(
+            img,
+            binner,
+            # bs_width=None,
+            mask_method=mask_method,
+        )
 
 # Median
 # binned outlier
@@ -28,6 +29,10 @@ for i in range(2):
 # numba median .270
 # multithread numba .178
 
+# Segmented median (single compiled pass, no pool)
+# binned outlier
+# numba segmented .294 (same machine as multithread numba median .375)
+
 # mask_img
 # numba .336
 # regular .520
@@ -37,3 +42,4 @@ for i in range(2):
 # numba 4.869
 # python 7.351
 # numba multithread 2.070
+# sorted extremes with running sums .817 (median .396 on the same machine)
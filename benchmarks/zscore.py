@@ -1,6 +1,6 @@
 from tifffile import imread
 import pyFAI
-from xpdtools.tools import map_to_binner, z_score_image
+from xpdtools.tools import generate_binner, z_score_image, binned_statistics
 from profilehooks import profile
 
 # dark_corrected_background.sink(print)
@@ -12,7 +12,8 @@ from profilehooks import profile
 geo = pyFAI.load("test.poni")
 img = imread("test.tiff")
 
-binner = map_to_binner(geo, img.shape)
+binner = generate_binner(geo, img.shape)
+stats = binned_statistics(img, binner)
 
 
 @profile(
@@ -26,3 +27,9 @@ def f(i):
 
 for i in range(10):
     f(i + 1)
+
+# z score (2048x2048)
+# python ring loop .229
+# compiled moments and gather .073
+# with the stats from binned_statistics .066
+# float32 output .047
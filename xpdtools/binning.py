@@ -0,0 +1,287 @@
+"""Precomputed pixel to bin structures shared between processing steps"""
+##############################################################################
+#
+# xpdtools            by Billinge Group
+#                   Simon J. L. Billinge sb2896@columbia.edu
+#                   (c) 2017 trustees of Columbia University in the City of
+#                        New York.
+#                   All rights reserved
+#
+# File coded by:    Christopher J. Wright
+#
+# See AUTHORS.txt for a list of people who contributed.
+# See LICENSE.txt for license information.
+#
+##############################################################################
+import numpy as np
+from skbeam.core.accumulators.binned_statistic import BinnedStatistic1D
+from skbeam.core.utils import bin_edges_to_centers
+
+
+def _compact_index(a, size):
+    """Cast an index array to the smallest integer type which can hold
+    ``size``"""
+    if size < np.iinfo(np.int32).max:
+        return np.asarray(a, dtype=np.int32)
+    return np.asarray(a, dtype=np.int64)
+
+
+def _mask_bins(xy, argsort_index, mask):
+    """Move the masked pixels to the first bin, as ``BinnedStatistic1D``
+    does, without sorting the pixels again
+
+    Parameters
+    ----------
+    xy : ndarray
+        The bin of each pixel
+    argsort_index : ndarray
+        The permutation which sorts ``xy``
+    mask : ndarray
+        The mask, True pixels are good pixels
+
+    Returns
+    -------
+    xy : ndarray
+        The bin of each pixel, with the masked pixels in bin 0
+    argsort_index : ndarray
+        The permutation which sorts the new ``xy``
+    """
+    mask = np.asarray(mask, dtype=bool).ravel()
+    xy = np.where(mask, xy, 0)
+    # the sorted bins stay sorted if the masked pixels are moved to the
+    # front, keeping the order of everything else
+    first = xy[argsort_index] == 0
+    argsort_index = np.concatenate(
+        (argsort_index[first], argsort_index[~first])
+    )
+    return xy, argsort_index
+
+
+class RingIndex(object):
+    """The pixels of a flattened image partitioned into rings (bins)
+
+    This holds everything the per ring routines need which only depends on
+    the geometry, the image shape and the mask, so it can be built once and
+    each new frame only needs ``ring_index.gather(img)``.
+    It can be used anywhere a ``BinnedStatistic1D`` is used for its
+    ``argsort_index`` and ``flatcount``.
+
+    Parameters
+    ----------
+    bin_index : ndarray
+        The bin of each pixel in the flattened image, as in
+        ``BinnedStatistic1D.xy``. Bin 0 holds the pixels below the bins
+        (and the masked pixels).
+    argsort_index : ndarray, optional
+        The permutation which sorts ``bin_index``, if None it is computed.
+        Defaults to None.
+    flatcount : ndarray, optional
+        The number of pixels in each bin, if None it is computed.
+        Defaults to None.
+    nbin : int, optional
+        The number of bins, including the outlier bins at either end as in
+        ``BinnedStatistic1D.nbin``, if None the length of ``flatcount``.
+        Defaults to None.
+
+    Attributes
+    ----------
+    positions : ndarray
+        The flattened pixel positions sorted by ring
+    offsets : ndarray
+        The start of each ring in ``positions``, with the total number of
+        pixels as the last element
+    flatcount : ndarray
+        The number of pixels in each ring
+    bin_index : ndarray
+        The ring of each pixel in the flattened image
+    nbin : ndarray
+        The number of bins, as a one element array like
+        ``BinnedStatistic1D.nbin``
+    """
+
+    def __init__(
+        self, bin_index, argsort_index=None, flatcount=None, nbin=None
+    ):
+        size = len(bin_index)
+        if argsort_index is None:
+            argsort_index = np.argsort(bin_index, kind="mergesort")
+        if flatcount is None:
+            flatcount = np.bincount(bin_index)
+        self.bin_index = _compact_index(bin_index, size)
+        self.positions = _compact_index(argsort_index, size)
+        self.flatcount = _compact_index(flatcount, size)
+        self.offsets = np.zeros(len(flatcount) + 1, dtype=np.int64)
+        np.cumsum(flatcount, out=self.offsets[1:])
+        if nbin is None:
+            nbin = len(flatcount)
+        self.nbin = np.asarray([nbin])
+
+    @classmethod
+    def from_binner(cls, binner, mask=None):
+        """Create a RingIndex from a binner
+
+        Parameters
+        ----------
+        binner : BinnedStatistic1D instance
+            The binner
+        mask : np.ndarray, optional
+            The mask to apply, if None no mask is applied. Defaults to None.
+
+        Returns
+        -------
+        RingIndex :
+            The ring index, using the same sort order as the binner
+        """
+        ri = cls(
+            binner.xy, binner.argsort_index, binner.flatcount, binner.nbin[0]
+        )
+        if mask is not None:
+            ri = ri.with_mask(mask)
+        return ri
+
+    @property
+    def argsort_index(self):
+        """The flattened pixel positions sorted by ring, for compatibility
+        with ``BinnedStatistic1D``"""
+        return self.positions
+
+    @property
+    def size(self):
+        """The number of pixels in the image"""
+        return len(self.bin_index)
+
+    @property
+    def nbytes(self):
+        """The memory used by the index arrays"""
+        return sum(
+            a.nbytes
+            for a in (
+                self.bin_index,
+                self.positions,
+                self.flatcount,
+                self.offsets,
+            )
+        )
+
+    def with_mask(self, mask):
+        """Create a RingIndex with masked pixels moved to the first bin
+
+        This mirrors the masking of ``BinnedStatistic1D`` without sorting
+        the pixels again.
+
+        Parameters
+        ----------
+        mask : np.ndarray
+            The mask, True pixels are good pixels
+
+        Returns
+        -------
+        RingIndex :
+            The masked ring index
+        """
+        bin_index, positions = _mask_bins(
+            self.bin_index, self.positions, mask
+        )
+        flatcount = np.bincount(bin_index, minlength=len(self.flatcount))
+        return type(self)(bin_index, positions, flatcount, self.nbin[0])
+
+    def gather(self, img):
+        """Get the pixel values sorted by ring
+
+        Parameters
+        ----------
+        img : np.ndarray
+            The image
+
+        Returns
+        -------
+        np.ndarray :
+            The flattened image values in ring order
+        """
+        return np.ravel(img)[self.positions]
+
+
+class PrecomputedBinner(BinnedStatistic1D):
+    """A ``BinnedStatistic1D`` built from an existing bin assignment
+
+    This skips the digitizing (and optionally the sorting) of the pixels,
+    which is most of the cost of creating a binner.
+
+    Parameters
+    ----------
+    xy : ndarray
+        The bin of each pixel in the flattened image, as in
+        ``BinnedStatistic1D.xy``
+    bins : ndarray
+        The bin edges
+    argsort_index : ndarray, optional
+        The permutation which sorts ``xy``, if None it is computed when
+        needed. Defaults to None.
+    flatcount : ndarray, optional
+        The number of pixels in each bin, if None it is computed when needed.
+        Defaults to None.
+    statistic : str or callable, optional
+        The default statistic. Defaults to "mean".
+    """
+
+    def __init__(
+        self, xy, bins, argsort_index=None, flatcount=None, statistic="mean"
+    ):
+        # the attributes BinnedStatisticDD sets, without digitizing
+        self.D = 1
+        self.edges = [np.asarray(bins, float)]
+        self.nbin = np.asarray([len(self.edges[0]) + 1])
+        self._centers = [bin_edges_to_centers(self.edges[0])]
+        self.ni = self.nbin.argsort()
+        self.xy = xy
+        self._flatcount = flatcount
+        self._argsort_index = argsort_index
+        self.statistic = statistic
+
+    @classmethod
+    def from_binner(cls, binner):
+        """Create a binner which shares the arrays of another binner
+
+        Parameters
+        ----------
+        binner : BinnedStatistic1D instance
+            The binner
+
+        Returns
+        -------
+        PrecomputedBinner :
+            The new binner
+        """
+        return cls(
+            binner.xy,
+            binner.bin_edges,
+            binner._argsort_index,
+            binner._flatcount,
+            binner.statistic,
+        )
+
+    def with_mask(self, mask):
+        """Create a binner with masked pixels moved to the first bin
+
+        This gives the same binner as passing the mask to
+        ``BinnedStatistic1D`` but reuses the bin assignment and sort order,
+        so only the counts are recomputed.
+
+        Parameters
+        ----------
+        mask : np.ndarray
+            The mask, True pixels are good pixels
+
+        Returns
+        -------
+        PrecomputedBinner :
+            The masked binner, of the same type as this binner
+        """
+        xy, argsort_index = _mask_bins(self.xy, self.argsort_index, mask)
+        return type(self)(
+            xy,
+            self.bin_edges,
+            argsort_index,
+            np.bincount(xy),
+            self.statistic,
+        )
@@ -0,0 +1,588 @@
+"""Caches for expensive data derived from the detector geometry"""
+##############################################################################
+#
+# xpdtools            by Billinge Group
+#                   Simon J. L. Billinge sb2896@columbia.edu
+#                   (c) 2017 trustees of Columbia University in the City of
+#                        New York.
+#                   All rights reserved
+#
+# File coded by:    Christopher J. Wright
+#
+# See AUTHORS.txt for a list of people who contributed.
+# See LICENSE.txt for license information.
+#
+##############################################################################
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from xpdtools import __version__
+
+
+def fingerprint(*args):
+    """Hash json serializable arguments into a cache key
+
+    Parameters
+    ----------
+    args : Any
+        The data to hash, anything which isn't json serializable is hashed by
+        its ``str``
+
+    Returns
+    -------
+    str :
+        The hex digest of the arguments
+    """
+    return hashlib.sha256(
+        json.dumps(args, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def array_fingerprint(*arrays):
+    """Hash the dtype, shape and contents of arrays into a cache key
+
+    Parameters
+    ----------
+    arrays : ndarray
+        The arrays to hash
+
+    Returns
+    -------
+    str :
+        The hex digest of the arrays
+    """
+    h = hashlib.sha256()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype.str, a.shape)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def file_fingerprint(filename, block_size=2 ** 20):
+    """Hash the contents of a file
+
+    Parameters
+    ----------
+    filename : str
+        The file
+    block_size : int, optional
+        The number of bytes read at a time. Defaults to 1MB.
+
+    Returns
+    -------
+    str :
+        The hex digest of the file
+    """
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def geometry_fingerprint(geo, img_shape):
+    """Hash the calibration and image shape into a cache key
+
+    Parameters
+    ----------
+    geo : pyFAI.geometry.Geometry instance
+        The calibrated geometry
+    img_shape : tuple
+        The shape of the image
+
+    Returns
+    -------
+    str :
+        The hex digest of the geometry parameters, the image shape and the
+        xpdtools version
+    """
+    # getPyFAI is deprecated in newer versions of pyFAI
+    get_config = getattr(geo, "get_config", None) or geo.getPyFAI
+    return fingerprint(
+        dict(
+            geometry=get_config(),
+            shape=[int(s) for s in img_shape],
+            version=__version__,
+        )
+    )
+
+
+class DiskCache(object):
+    """Content addressed on disk store of named arrays
+
+    Each entry is a directory named by its key holding one ``.npy`` file per
+    array, so entries are loaded back memory mapped. When the cache grows
+    over ``max_bytes`` the least recently used entries are removed.
+    The cache is best effort, if the directory can't be used the cache
+    misses rather than raising.
+
+    Parameters
+    ----------
+    directory : str, optional
+        The cache directory. If None use the ``XPDTOOLS_CACHE_DIR``
+        environment variable or ``~/.cache/xpdtools``. If empty the cache is
+        disabled. Defaults to None.
+    max_bytes : int, optional
+        The size of the cache. If None use the ``XPDTOOLS_CACHE_SIZE``
+        environment variable or 2 GB. Defaults to None.
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        if directory is None:
+            directory = os.environ.get(
+                "XPDTOOLS_CACHE_DIR",
+                os.path.join(os.path.expanduser("~"), ".cache", "xpdtools"),
+            )
+        if max_bytes is None:
+            max_bytes = int(
+                os.environ.get("XPDTOOLS_CACHE_SIZE", 2 * 1024 ** 3)
+            )
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and self.max_bytes > 0
+
+    def get(self, key, names):
+        """Load arrays from the cache
+
+        Parameters
+        ----------
+        key : str
+            The entry key
+        names : iterable of str
+            The names of the arrays to load
+
+        Returns
+        -------
+        dict or None :
+            The memory mapped (read only) arrays by name, None if the entry
+            or any of the arrays is missing
+        """
+        if not self.enabled:
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            out = {
+                n: np.load(os.path.join(path, n + ".npy"), mmap_mode="r")
+                for n in names
+            }
+            # mark as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return out
+
+    def put(self, key, **arrays):
+        """Store arrays in the cache, adding them to any existing entry
+
+        Parameters
+        ----------
+        key : str
+            The entry key
+        arrays : dict
+            The arrays to store by name
+        """
+        if not self.enabled:
+            return
+        path = os.path.join(self.directory, key)
+        try:
+            os.makedirs(path, exist_ok=True)
+            for name, a in arrays.items():
+                # write then move so readers never see a partial file
+                fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=path)
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, np.asarray(a))
+                os.replace(tmp, os.path.join(path, name + ".npy"))
+            self.evict()
+        except OSError:
+            pass
+
+    def get_object(self, key):
+        """Load a pickled object from the cache
+
+        Parameters
+        ----------
+        key : str
+            The entry key
+
+        Returns
+        -------
+        Any :
+            The object, ``_missing`` if the entry is missing
+        """
+        if not self.enabled:
+            return _missing
+        path = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(path, "object.pkl"), "rb") as f:
+                out = pickle.load(f)
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return _missing
+        return out
+
+    def put_object(self, key, obj):
+        """Store a pickled object in the cache
+
+        Parameters
+        ----------
+        key : str
+            The entry key
+        obj : Any
+            The object to store
+        """
+        if not self.enabled:
+            return
+        path = os.path.join(self.directory, key)
+        try:
+            os.makedirs(path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=path)
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, os.path.join(path, "object.pkl"))
+            self.evict()
+        except (OSError, pickle.PicklingError):
+            pass
+
+    def entries(self):
+        """The cache entries
+
+        Returns
+        -------
+        list of tuple :
+            The last use time, size in bytes and path of each entry, least
+            recently used first
+        """
+        out = []
+        try:
+            keys = os.listdir(self.directory)
+        except OSError:
+            return out
+        for key in keys:
+            path = os.path.join(self.directory, key)
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(path, f))
+                    for f in os.listdir(path)
+                )
+                out.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+        return sorted(out)
+
+    @property
+    def nbytes(self):
+        """The size of the cache on disk"""
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in
+        ``max_bytes``"""
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Remove all the entries"""
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def sizeof(obj):
+    """Estimate the memory held by the arrays in an object
+
+    Parameters
+    ----------
+    obj : Any
+        An array, an object with a ``nbytes`` attribute, a binner, a pyFAI
+        geometry (by the arrays it caches) or a tuple/list of those.
+        Anything else counts as zero.
+
+    Returns
+    -------
+    int :
+        The size in bytes
+    """
+    if isinstance(obj, (tuple, list)):
+        return sum(sizeof(o) for o in obj)
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+    # binners
+    if hasattr(obj, "xy"):
+        return sum(
+            sizeof(getattr(obj, a, None))
+            for a in ("xy", "_argsort_index", "_flatcount")
+        )
+    # pyFAI geometries keep the arrays they compute
+    arrays = getattr(obj, "_cached_array", None)
+    if isinstance(arrays, dict):
+        return sum(
+            sizeof(a) for a in arrays.values() if isinstance(a, np.ndarray)
+        )
+    return 0
+
+
+_missing = object()
+
+
+def _freeze(value):
+    """Make the arrays of a cached item read only, the item is shared by
+    everyone who gets it from the cache"""
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            _freeze(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _freeze(v)
+    return value
+
+
+class LRUCache(object):
+    """Thread safe, memory bounded least recently used cache
+
+    The arrays of the items (arrays and tuples, lists and dicts of arrays)
+    are made read only when they are added, as every lookup returns the
+    same object.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The memory budget, the least recently used items are dropped when the
+        (estimated) size of the items goes over it. If None use the
+        ``XPDTOOLS_MEMORY_CACHE_SIZE`` environment variable or 1 GB.
+        Defaults to None.
+
+    Attributes
+    ----------
+    hits : int
+        The number of lookups which found their key
+    misses : int
+        The number of lookups which didn't find their key
+    """
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = int(
+                os.environ.get("XPDTOOLS_MEMORY_CACHE_SIZE", 1024 ** 3)
+            )
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @property
+    def nbytes(self):
+        """The estimated size of the cached items"""
+        return self._nbytes
+
+    @property
+    def hit_rate(self):
+        """The fraction of lookups which were hits"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def get(self, key, default=None):
+        """Get an item, marking it as recently used
+
+        Parameters
+        ----------
+        key : hashable
+            The key
+        default : Any, optional
+            Returned if the key is missing. Defaults to None.
+
+        Returns
+        -------
+        Any :
+            The item
+        """
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, nbytes=None):
+        """Add an item, dropping least recently used items to stay in budget
+
+        Parameters
+        ----------
+        key : hashable
+            The key
+        value : Any
+            The item
+        nbytes : int, optional
+            The size of the item, if None it is estimated with ``sizeof``
+            when it is added. Defaults to None.
+        """
+        if nbytes is None:
+            nbytes = sizeof(value)
+        with self._lock:
+            self._nbytes -= self._sizes.pop(key, 0)
+            self._data[key] = _freeze(value)
+            self._data.move_to_end(key)
+            self._sizes[key] = nbytes
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes and len(self._data) > 1:
+                old, _ = self._data.popitem(last=False)
+                self._nbytes -= self._sizes.pop(old)
+            # items bigger than the budget aren't kept
+            if self._nbytes > self.max_bytes:
+                self.clear()
+
+    def cached_call(self, key, func, *args, **kwargs):
+        """Get an item, computing and adding it if it is missing
+
+        Parameters
+        ----------
+        key : hashable
+            The key
+        func : callable
+            Computes the item from ``args`` and ``kwargs``
+
+        Returns
+        -------
+        Any :
+            The item
+        """
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = func(*args, **kwargs)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        """Remove all the items"""
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._nbytes = 0
+
+
+def _argument_fingerprint(a):
+    if isinstance(a, np.ndarray):
+        return array_fingerprint(a)
+    return fingerprint(a)
+
+
+class ResultCache(object):
+    """Memoize function results by a hash of the function and its
+    arguments, in memory and optionally on disk
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The memory budget of the in memory cache, see ``LRUCache``.
+        Defaults to None.
+    directory : str, optional
+        The directory of the on disk cache, if None or empty the results are
+        only kept in memory. Defaults to None.
+    max_disk_bytes : int, optional
+        The size of the on disk cache, see ``DiskCache``. Defaults to None.
+
+    Attributes
+    ----------
+    hits : int
+        The number of calls answered from the cache
+    misses : int
+        The number of calls which ran the function
+    """
+
+    def __init__(self, max_bytes=None, directory=None, max_disk_bytes=None):
+        self.memory = LRUCache(max_bytes)
+        self.disk = DiskCache(directory or "", max_disk_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        """The fraction of calls answered from the cache"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    @staticmethod
+    def key(func, *args, **kwargs):
+        """Hash a function and its arguments into a cache key
+
+        Arrays are hashed by their contents, everything else by its json
+        representation (or ``str``).
+        """
+        h = hashlib.sha256()
+        h.update(fingerprint(func.__module__, func.__qualname__).encode())
+        h.update(__version__.encode())
+        for a in args:
+            h.update(_argument_fingerprint(a).encode())
+        for k in sorted(kwargs):
+            h.update(k.encode())
+            h.update(_argument_fingerprint(kwargs[k]).encode())
+        return h.hexdigest()
+
+    def cached_call(self, func, *args, **kwargs):
+        """Call a function, returning the cached result for the same
+        arguments if there is one
+
+        Parameters
+        ----------
+        func : callable
+            The function
+
+        Returns
+        -------
+        Any :
+            The result
+        """
+        key = self.key(func, *args, **kwargs)
+        value = self.memory.get(key, _missing)
+        if value is _missing:
+            value = self.disk.get_object(key)
+            if value is not _missing:
+                self.memory.put(key, value)
+        if value is not _missing:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = func(*args, **kwargs)
+        self.memory.put(key, value)
+        self.disk.put_object(key, value)
+        return value
+
+    def clear(self):
+        """Remove all the results, in memory and on disk"""
+        self.memory.clear()
+        self.disk.clear()
+
+
+# The cache for q maps, bins and binners
+geometry_cache = DiskCache()
+# The in process cache for geometries and geometry derived arrays
+memory_cache = LRUCache()
+# The cache for PDF results, on disk if ``XPDTOOLS_PDF_CACHE_DIR`` is set
+pdf_cache = ResultCache(directory=os.environ.get("XPDTOOLS_PDF_CACHE_DIR"))
@@ -1,5 +1,11 @@
 """Main entry point for processing images to I(Q)"""
+import json
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import repeat
 
 import fabio
 import fire
@@ -13,17 +19,111 @@ from xpdtools.pipelines.raw_pipeline import (
     namespace as general_namespace,
 )
 from rapidz.link import link
-from xpdtools.pipelines.extra import median_gen, std_gen, z_score_gen
+from xpdtools import __version__
+from xpdtools.cache import array_fingerprint, file_fingerprint, fingerprint
+from xpdtools.hdf5 import HDF5Writer
+from xpdtools.writers import AsyncWriter
+from xpdtools.pipelines.extra import stats_gen, z_score_gen
+from xpdtools.tools import (
+    correct_image,
+    generate_binner,
+    generate_polarization,
+    generate_polarization_terms,
+    save_mask,
+)
 
 img_extensions = {".tiff", ".edf", ".tif"}
+# files holding stacks of frames, which are only read if they are passed in
+container_extensions = {".h5", ".hdf5", ".nxs"}
+# images written by the pipeline, which are not inputs
+output_suffixes = ("_zscore.tif",)
+# the outputs and the files written for each image
+all_outputs = ("mean", "median", "std", "mask", "zscore")
+output_extensions = {
+    "mean": (".chi",),
+    "median": ("_median.chi",),
+    "std": ("_std.chi",),
+    "mask": (".msk", "_mask.npy"),
+    "zscore": ("_zscore.tif",),
+}
+
+
+def parse_outputs(outputs=None):
+    """Parse the outputs to write
+
+    Parameters
+    ----------
+    outputs : str or list of str, optional
+        The outputs, a comma separated string or a list of the names in
+        ``all_outputs``. If None all the outputs are written. Defaults to
+        None.
+
+    Returns
+    -------
+    tuple of str :
+        The outputs, in the order of ``all_outputs``
+    """
+    if outputs is None:
+        return all_outputs
+    if isinstance(outputs, str):
+        outputs = outputs.split(",")
+    outputs = {o.strip() for o in outputs}
+    unknown = outputs - set(all_outputs)
+    if unknown:
+        raise ValueError(
+            "Unknown outputs {}, the outputs are {}".format(
+                sorted(unknown), all_outputs
+            )
+        )
+    return tuple(o for o in all_outputs if o in outputs)
 
 
-def make_pipeline(_output_sinks=True):
+def make_pipeline(
+    _output_sinks=True,
+    outputs=None,
+    writer=None,
+    async_writer=None,
+    mask_writer=None,
+    written_files=None,
+):
+    """Build the pipeline, with the writers of the requested outputs
+
+    Parameters
+    ----------
+    _output_sinks : bool, optional
+        If True collect the q, mean, median and standard deviation values in
+        lists. Defaults to True.
+    outputs : str or list of str, optional
+        The outputs to write, see ``parse_outputs``. The statistics and z
+        scores which are not written are not computed. If None all the
+        outputs are written. Defaults to None.
+    writer : HDF5Writer, optional
+        Writes the outputs of all the images into one HDF5 file, if None
+        each output of each image is written to its own file. Defaults to
+        None.
+    async_writer : AsyncWriter, optional
+        Runs the writes on a background thread, if None the writes are done
+        as the results are computed. Defaults to None.
+    mask_writer : MaskWriter, optional
+        Writes the masks, if None a ``MaskWriter`` writing to ``writer``.
+        Defaults to None.
+    written_files : WrittenFiles, optional
+        Records the files written for each image and the images with a
+        failed write, if None nothing is recorded. Defaults to None.
+
+    Returns
+    -------
+    ns : dict
+        The namespace of the pipeline
+    """
+    outputs = parse_outputs(outputs)
+    chunks = list(pipeline_order)
+    if "median" in outputs or "std" in outputs:
+        chunks.append(stats_gen)
+    if "zscore" in outputs:
+        chunks.append(z_score_gen)
     # link the pipeline up
-    namespace = link(
-        *(pipeline_order + [median_gen, std_gen, z_score_gen]),
-        **general_namespace
-    )
+    namespace = link(*chunks, **general_namespace)
 
     polarization_array = namespace["polarization_array"]
     mask = namespace["mask"]
@@ -35,54 +135,1071 @@ def make_pipeline(_output_sinks=True):
     mask_kwargs = namespace["mask_kwargs"]
     mask_setting = namespace["mask_setting"]
 
-    median = namespace["median"]
-    std = namespace["std"]
-    z_score = namespace["z_score"]
+    median = namespace.get("median")
+    std = namespace.get("std")
+    z_score = namespace.get("z_score")
 
     # Modify graph
     # create filename nodes
     filename_source = Stream(stream_name="filename")
     filename_node = filename_source.map(lambda x: os.path.splitext(x)[0])
+    if _output_sinks:
+        outs = [q, mean, median, std]
+        out_tup = tuple([[] for _ in outs])
+        out_sinks = tuple(
+            [
+                k.sink(L.append)
+                for k, L in zip(outs, out_tup)
+                if k is not None
+            ]
+        )
+
+    def writes(func):
+        if async_writer is None:
+            return func
+        return async_writer.wrap(func)
+
     # write out mask
-    mask.combine_latest(filename_node, emit_on=0).sink(
-        lambda x: fit2d_save(np.flipud(x[0]), x[1])
+    if "mask" in outputs:
+        if mask_writer is None:
+            mask_writer = MaskWriter(writer, written_files=written_files)
+        mask.combine_latest(filename_source, emit_on=0).starsink(
+            writes(mask_writer)
+        )
+
+    if writer is not None:
+        # every output of every image goes into the HDF5 file, with the
+        # image it came from
+        for name, stream in [
+            ("mean", mean),
+            ("median", median),
+            ("std", std),
+        ]:
+            if name not in outputs:
+                continue
+            (
+                stream.zip(q)
+                .combine_latest(filename_source, emit_on=0)
+                .starsink(
+                    writes(
+                        lambda x, fn, name=name: _tracked(
+                            written_files,
+                            os.path.splitext(fn)[0],
+                            (),
+                            writer.append,
+                            name,
+                            data=x[0],
+                            q=x[1],
+                            filename=fn,
+                        )
+                    )
+                )
+            )
+        if "zscore" in outputs:
+            z_score.combine_latest(filename_source, emit_on=0).starsink(
+                writes(
+                    lambda img, fn: _tracked(
+                        written_files,
+                        os.path.splitext(fn)[0],
+                        (),
+                        writer.append,
+                        "zscore",
+                        data=img.astype(np.float32),
+                        filename=fn,
+                    )
+                )
+            )
+    else:
+        for name, stream, suffix in [
+            ("mean", mean, ""),
+            ("median", median, "_median"),
+            ("std", std, "_std"),
+        ]:
+            if name not in outputs:
+                continue
+            (
+                stream.zip(q)
+                .combine_latest(filename_node, emit_on=0)
+                .map(lambda l: (*l[0], l[1]))
+                .sink(
+                    writes(
+                        partial(
+                            _save_chi,
+                            suffix=suffix,
+                            written_files=written_files,
+                        )
+                    )
+                )
+            )
+        if "zscore" in outputs:
+            (
+                z_score.combine_latest(filename_node, emit_on=0).starsink(
+                    writes(
+                        partial(_save_zscore, written_files=written_files)
+                    )
+                )
+            )
+    # If running from a terminal don't output stuff into lists (too much mem)
+    return locals()
+
+
+def _tracked(written_files, base, files, func, *args, **kwargs):
+    if written_files is None:
+        return func(*args, **kwargs)
+    return written_files.write(base, files, func, *args, **kwargs)
+
+
+def _save_chi(x, suffix, written_files):
+    q, data, base = x
+    _tracked(
+        written_files,
+        base,
+        [base + suffix + ".chi"],
+        save_output,
+        data,
+        q,
+        base + suffix,
+        "Q",
     )
-    mask.combine_latest(filename_node, emit_on=0).sink(
-        lambda x: np.save(x[1] + "_mask.npy", x[0])
+
+
+def _save_zscore(img, base, written_files):
+    fn = base + "_zscore.tif"
+    _tracked(
+        written_files,
+        base,
+        [fn],
+        tifffile.imsave,
+        fn,
+        data=img.astype(np.float32),
     )
 
-    if _output_sinks:
-        outs = [q, mean, median, std]
-        out_tup = tuple([[] for _ in outs])
-        out_sinks = tuple([k.sink(L.append) for k, L in zip(outs, out_tup)])
 
-    (
-        mean.zip(q)
-        .combine_latest(filename_node, emit_on=0)
-        .map(lambda l: (*l[0], l[1]))
-        .sink(lambda x: save_output(x[1], x[0], x[2], "Q"))
+class WrittenFiles(object):
+    """The files written for each image, and the images with a failed write
+
+    The files of an image are recorded when they are written, an image is
+    marked as failed if any of its writes raises.
+
+    Attributes
+    ----------
+    files : dict
+        The files of each image, by the image file without its extension
+    failed : set
+        The images, without their extension, with a failed write
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.failed = set()
+
+    def write(self, base, files, func, *args, **kwargs):
+        """Run a write of the files of an image
+
+        Parameters
+        ----------
+        base : str
+            The image file without its extension
+        files : list of str
+            The files the write makes
+        func : callable
+            The write
+        args, kwargs :
+            The arguments of the write
+        """
+        self.files.setdefault(base, []).extend(files)
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            self.failed.add(base)
+            raise
+
+    def pop(self, bases):
+        """Forget images, returning their files
+
+        Parameters
+        ----------
+        bases : list of str
+            The image files without their extension, eg the frames of a file
+
+        Returns
+        -------
+        list of str or None :
+            The files of the images, None if a write of any of them failed
+        """
+        files = []
+        failed = False
+        for b in bases:
+            files.extend(self.files.pop(b, []))
+            if b in self.failed:
+                self.failed.discard(b)
+                failed = True
+        return None if failed else files
+
+
+def is_image_file(filename):
+    """Whether a file is an image to process
+
+    Parameters
+    ----------
+    filename : str
+        The file
+
+    Returns
+    -------
+    bool :
+        True if the file has an image extension and is not an output of the
+        pipeline
+    """
+    return os.path.splitext(filename)[-1] in img_extensions and not (
+        filename.endswith(output_suffixes)
     )
-    (
-        median.zip(q)
-        .combine_latest(filename_node, emit_on=0)
-        .map(lambda l: (*l[0], l[1]))
-        .sink(lambda x: save_output(x[1], x[0], x[2] + "_median", "Q"))
+
+
+class FrameStack(object):
+    """The frames of a multi frame file, read when they are needed
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the stack, the number of frames first
+    read : callable
+        ``read(start, stop)`` reads the frames ``start:stop``
+    close : callable, optional
+        Releases the file. Defaults to None.
+    """
+
+    def __init__(self, shape, read, close=None):
+        self.shape = tuple(shape)
+        self._read = read
+        self._close = close
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read(self, start, stop):
+        """Read frames
+
+        Parameters
+        ----------
+        start, stop : int
+            The frames to read, ``start:stop``
+
+        Returns
+        -------
+        ndarray :
+            The frames, shaped ``(stop - start,) + frame shape``
+        """
+        return np.reshape(
+            self._read(start, stop), (stop - start,) + self.shape[1:]
+        )
+
+    def close(self):
+        """Release the file"""
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+
+def read_image(filename, out=None):
+    """Read an image with fabio
+
+    The image keeps the detector's dtype, the background subtraction
+    converts it to float.
+
+    Parameters
+    ----------
+    filename : str
+        The image file
+    out : ndarray, optional
+        Ignored, fabio always decodes into a new array. Accepted so all the
+        readers can be used with ``prefetch_images``. Defaults to None.
+
+    Returns
+    -------
+    ndarray or FrameStack :
+        The image, or the frames of a multi frame file
+    """
+    img = fabio.open(filename)
+    if img.nframes > 1:
+        return FrameStack(
+            (img.nframes,) + img.data.shape,
+            lambda start, stop: np.stack(
+                [img.getframe(i).data for i in range(start, stop)]
+            ),
+        )
+    return img.data
+
+
+def read_tiff(filename, out=None):
+    """Read a tiff with tifffile
+
+    The frames of a multi page tiff are memory mapped if they are stored
+    uncompressed and contiguously, otherwise they are read page by page.
+
+    Parameters
+    ----------
+    filename : str
+        The image file
+    out : ndarray, optional
+        The array to decode a single page into, if it does not match the
+        image's shape and dtype a new array is used. Defaults to None.
+
+    Returns
+    -------
+    ndarray or FrameStack :
+        The image, or the frames of a multi page tiff
+    """
+    tif = tifffile.TiffFile(filename)
+    n_frames = len(tif.pages)
+    if n_frames == 1:
+        with tif:
+            if isinstance(out, np.ndarray):
+                try:
+                    return tif.asarray(out=out)
+                except ValueError:
+                    pass
+            return tif.asarray()
+    shape = (n_frames,) + tif.pages[0].shape
+    try:
+        mm = tifffile.memmap(filename, mode="r")
+    except ValueError:
+        mm = None
+    if mm is not None and mm.shape == shape:
+        tif.close()
+        return FrameStack(shape, lambda start, stop: mm[start:stop])
+    return FrameStack(
+        shape,
+        lambda start, stop: np.stack(
+            [tif.pages[i].asarray() for i in range(start, stop)]
+        ),
+        tif.close,
     )
-    (
-        std.zip(q)
-        .combine_latest(filename_node, emit_on=0)
-        .map(lambda l: (*l[0], l[1]))
-        .sink(lambda x: save_output(x[1], x[0], x[2] + "_std", "Q"))
+
+
+def read_hdf5_frames(filename, out=None, dataset=None):
+    """Read the frames of an HDF5 dataset
+
+    The frames are memory mapped if the dataset is stored uncompressed and
+    contiguously, otherwise they are read a block of frames at a time.
+
+    Parameters
+    ----------
+    filename : str
+        The HDF5 file
+    out : ndarray, optional
+        Ignored. Defaults to None.
+    dataset : str, optional
+        The path of the dataset in the file, if None the first three
+        dimensional dataset. Defaults to None.
+
+    Returns
+    -------
+    ndarray or FrameStack :
+        The image of a two dimensional dataset, otherwise the frames
+    """
+    import h5py
+
+    def find_stack(name, obj):
+        if isinstance(obj, h5py.Dataset) and obj.ndim == 3:
+            return name
+
+    f = h5py.File(filename, "r")
+    if dataset is None:
+        dataset = f.visititems(find_stack)
+        if dataset is None:
+            f.close()
+            raise ValueError("There is no stack of images in " + filename)
+    ds = f[dataset]
+    shape, dtype = ds.shape, ds.dtype
+    if ds.ndim == 2:
+        with f:
+            return ds[()]
+    offset = ds.id.get_offset()
+    if ds.chunks is None and offset is not None:
+        f.close()
+        mm = np.memmap(filename, dtype, "r", offset, shape)
+        return FrameStack(shape, lambda start, stop: mm[start:stop])
+    return FrameStack(shape, lambda start, stop: ds[start:stop], f.close)
+
+
+def read_file(filename, out=None, dataset=None):
+    """Read an image with tifffile if it is a tiff, with h5py if it is an
+    HDF5 file, otherwise with fabio
+
+    Parameters
+    ----------
+    filename : str
+        The image file
+    out : ndarray, optional
+        The array to decode a tiff into. Defaults to None.
+    dataset : str, optional
+        The dataset of the frames in HDF5 files, see ``read_hdf5_frames``.
+        Defaults to None.
+
+    Returns
+    -------
+    ndarray or FrameStack :
+        The image, or the frames of a multi frame file
+    """
+    if filename.endswith((".tiff", ".tif")):
+        return read_tiff(filename, out)
+    if os.path.splitext(filename)[-1] in container_extensions:
+        return read_hdf5_frames(filename, dataset=dataset)
+    return read_image(filename, out)
+
+
+def prefetch_images(filenames, reader, prefetch=4, reuse_buffers=False):
+    """Read images ahead of their use on a thread pool
+
+    Parameters
+    ----------
+    filenames : iterable of str
+        The image files
+    reader : callable
+        Reads an image file, if ``reuse_buffers`` it may be passed an ``out``
+        array to decode the image into
+    prefetch : int, optional
+        The number of files read ahead, if 0 each file is read when it is
+        needed. Defaults to 4.
+    reuse_buffers : bool, optional
+        If True the arrays of the images which have been processed are handed
+        back to the reader for the next images. Only the last image yielded
+        stays untouched, so the consumer must not keep references to older
+        images. Defaults to False.
+
+    Yields
+    ------
+    filename : str
+        The image file
+    img : ndarray
+        The image
+    """
+    held = deque()
+
+    def buffer_kwargs():
+        if reuse_buffers and len(held) > 1:
+            return dict(out=held.popleft())
+        return {}
+
+    filenames = iter(filenames)
+    if not prefetch:
+        for fn in filenames:
+            img = reader(fn, **buffer_kwargs())
+            yield fn, img
+            held.append(img)
+        return
+
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+        # the queue of reads is bounded by the prefetch depth
+        pending = deque(
+            (fn, pool.submit(reader, fn, **buffer_kwargs()))
+            for _, fn in zip(range(prefetch), filenames)
+        )
+        try:
+            while pending:
+                fn, future = pending.popleft()
+                img = future.result()
+                next_fn = next(filenames, None)
+                if next_fn is not None:
+                    future = pool.submit(reader, next_fn, **buffer_kwargs())
+                    pending.append((next_fn, future))
+                yield fn, img
+                held.append(img)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def frame_name(filename, frame, n_frames):
+    """The name of a frame of a multi frame file, which names its outputs
+
+    Parameters
+    ----------
+    filename : str
+        The file
+    frame : int
+        The frame
+    n_frames : int
+        The number of frames in the file, the frame numbers are zero padded
+        to the same width
+
+    Returns
+    -------
+    str :
+        The name, ``<file>_<frame>`` with the file's extension
+    """
+    base, ext = os.path.splitext(filename)
+    return "{}_{:0{}d}{}".format(base, frame, len(str(n_frames - 1)), ext)
+
+
+def iter_frames(images, batch=8):
+    """Split the multi frame files into frames
+
+    Parameters
+    ----------
+    images : iterable of (str, ndarray or FrameStack)
+        The files and their images or frames, eg from ``prefetch_images``
+    batch : int, optional
+        The number of frames read from a file at once. Defaults to 8.
+
+    Yields
+    ------
+    filename : str
+        The file
+    name : str
+        The name of the frame, the file for single frame files
+    img : ndarray
+        The frame
+    last : bool
+        Whether this is the last frame of the file
+    """
+    for fn, data in images:
+        if not isinstance(data, FrameStack):
+            yield fn, fn, data, True
+            continue
+        n = len(data)
+        try:
+            for start in range(0, n, batch):
+                block = data.read(start, min(start + batch, n))
+                for i, frame in enumerate(block, start):
+                    yield fn, frame_name(fn, i, n), frame, i == n - 1
+        finally:
+            data.close()
+
+
+def find_images(image_files=None):
+    """Find the images to process and how to read them
+
+    Parameters
+    ----------
+    image_files : str or list of str, optional
+        The image files, if None use all the image files in the current
+        directory. Defaults to None.
+
+    Returns
+    -------
+    img_filenames : list of str
+        The image files
+    reader : callable
+        Reads an image file
+    """
+    if image_files is None:
+        img_filenames = [i for i in os.listdir(".") if is_image_file(i)]
+        # TODO: Test non tiff files
+        if all(
+            [f.endswith(".tiff") or f.endswith(".tif") for f in img_filenames]
+        ):
+            return img_filenames, read_tiff
+        return img_filenames, read_file
+    if isinstance(image_files, str):
+        image_files = (image_files,)
+    return list(image_files), read_file
+
+
+def mask_files(base, pack=False):
+    """The fit2d and numpy mask files of an image
+
+    Parameters
+    ----------
+    base : str
+        The image file without its extension
+    pack : bool, optional
+        If True the numpy mask is bit packed. Defaults to False.
+
+    Returns
+    -------
+    list of str :
+        The mask files
+    """
+    return [base + ".msk", base + ("_mask.npz" if pack else "_mask.npy")]
+
+
+def _link(src, dst):
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return
+    if os.path.lexists(dst):
+        os.remove(dst)
+    os.link(src, dst)
+
+
+class MaskWriter(object):
+    """Write the mask of each image, a mask which is the same as the last
+    one written is only referenced
+
+    A mask is unchanged if it is the same array, or has the same contents,
+    as the last mask written. In files the unchanged masks are hard links to
+    the files of the last mask written. In HDF5 the ``mask`` group holds the
+    distinct masks in ``data`` and, for each image, its ``filename`` and the
+    row of its mask in ``index``.
+
+    Parameters
+    ----------
+    writer : HDF5Writer, optional
+        The HDF5 file to write to, if None write files for each image.
+        Defaults to None.
+    pack : bool, optional
+        If True write the numpy masks bit packed, see
+        ``xpdtools.tools.load_mask``. Defaults to False.
+    dedup : bool, optional
+        If True only write the masks which change. Defaults to True.
+    written_files : WrittenFiles, optional
+        Records the mask files of each image, if None nothing is recorded.
+        Defaults to None.
+
+    Attributes
+    ----------
+    written : int
+        The number of masks written
+    referenced : int
+        The number of masks referencing a mask already written
+    """
+
+    def __init__(
+        self, writer=None, pack=False, dedup=True, written_files=None
+    ):
+        self.writer = writer
+        self.pack = pack
+        self.dedup = dedup
+        self.written_files = written_files
+        self.written = 0
+        self.referenced = 0
+        self._mask = None
+        self._fingerprint = None
+        self._files = None
+        self._row = -1
+
+    def _unchanged(self, mask):
+        if not self.dedup or self._fingerprint is None:
+            return False
+        return mask is self._mask or (
+            array_fingerprint(mask) == self._fingerprint
+        )
+
+    def _remember(self, mask):
+        self.written += 1
+        if self.dedup:
+            self._mask = mask
+            self._fingerprint = array_fingerprint(mask)
+
+    def __call__(self, mask, filename):
+        """Write the mask of an image
+
+        Parameters
+        ----------
+        mask : np.ndarray or None
+            The mask, if None nothing is written
+        filename : str
+            The image file
+        """
+        if mask is None:
+            return
+        base = os.path.splitext(filename)[0]
+        files = () if self.writer is not None else mask_files(base, self.pack)
+        _tracked(self.written_files, base, files, self._write, mask, filename)
+
+    def _write(self, mask, filename):
+        unchanged = self._unchanged(mask)
+        if self.writer is not None:
+            if unchanged:
+                self.referenced += 1
+            else:
+                self.writer.append("mask", data=mask)
+                self._row += 1
+                self._remember(mask)
+            self.writer.append("mask", index=self._row, filename=filename)
+            return
+
+        files = mask_files(os.path.splitext(filename)[0], self.pack)
+        if unchanged:
+            try:
+                for src, dst in zip(self._files, files):
+                    _link(src, dst)
+                self.referenced += 1
+                return
+            # eg the file system does not support hard links
+            except OSError:
+                pass
+        # don't write through a link to the mask of another image
+        for f in files:
+            if os.path.lexists(f):
+                os.remove(f)
+        fit2d_save(np.flipud(mask), os.path.splitext(files[0])[0])
+        save_mask(files[1], mask, self.pack)
+        self._files = files
+        self._remember(mask)
+
+
+def settings_fingerprint(settings, poni_file, bg_file=None):
+    """Hash everything the outputs of an image depend on, besides the image
+
+    Parameters
+    ----------
+    settings : dict
+        The settings for the pipeline, as passed to ``process_files``
+    poni_file : str
+        The calibration file
+    bg_file : str, optional
+        The background image file. Defaults to None.
+
+    Returns
+    -------
+    str :
+        The hex digest of the settings
+    """
+    mask_kwargs = dict(settings["mask_kwargs"])
+    tmsk = mask_kwargs.pop("tmsk", None)
+    # the number of threads does not change the mask
+    mask_kwargs.pop("max_workers", None)
+    return fingerprint(
+        {k: v for k, v in settings.items() if k != "mask_kwargs"},
+        mask_kwargs,
+        None if tmsk is None else array_fingerprint(tmsk),
+        file_fingerprint(poni_file),
+        None if bg_file is None else file_fingerprint(bg_file),
+        __version__,
     )
-    (
-        z_score.combine_latest(filename_node, emit_on=0).starsink(
-            lambda img, n: tifffile.imsave(
-                n + "_zscore.tif", data=img.astype(np.float32)
-            )
+
+
+class Manifest(object):
+    """The processed image files, recorded in a JSON lines file so a rerun
+    only processes new or changed images
+
+    Each record holds the size, modification time and hash of the image, the
+    fingerprint of the processing parameters and the output files. Later
+    records of a file replace earlier ones.
+
+    Parameters
+    ----------
+    filename : str, optional
+        The manifest file. If None the records are only kept in memory.
+        Defaults to None.
+    params : str, optional
+        The fingerprint of the processing parameters (see
+        ``settings_fingerprint``), images processed with other parameters
+        are processed again. Defaults to None.
+    """
+
+    def __init__(self, filename=None, params=None):
+        self.filename = filename
+        self.params = params
+        self.records = {}
+        # the last line of an interrupted run may be partial
+        self._newline = False
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    self._newline = not line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[record["file"]] = record
+
+    def __contains__(self, filename):
+        """Whether the image was processed with these parameters, is
+        unchanged and its outputs exist"""
+        record = self.records.get(os.path.abspath(filename))
+        if record is None or record["params"] != self.params:
+            return False
+        # a record without outputs is not a finished image
+        if not record.get("outputs"):
+            return False
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        if st.st_size != record["size"] or not all(
+            os.path.exists(f) for f in record["outputs"]
+        ):
+            return False
+        # only hash the files which were touched
+        if st.st_mtime == record["mtime"]:
+            return True
+        return file_fingerprint(filename) == record["hash"]
+
+    def add(self, filename, outputs):
+        """Record a processed image
+
+        Parameters
+        ----------
+        filename : str
+            The image file
+        outputs : list of str
+            The files written for the image, an image without outputs is
+            not done
+        """
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        record = dict(
+            file=filename,
+            size=st.st_size,
+            mtime=st.st_mtime,
+            hash=file_fingerprint(filename),
+            params=self.params,
+            outputs=[os.path.abspath(f) for f in outputs],
         )
+        self.records[filename] = record
+        if self.filename is not None:
+            with open(self.filename, "a") as f:
+                if self._newline:
+                    f.write("\n")
+                    self._newline = False
+                f.write(json.dumps(record) + "\n")
+
+
+def watch_images(
+    directory=".", poll_interval=1., settle_time=None, timeout=None, done=()
+):
+    """Yield the new image files of a directory once they are complete
+
+    The directory is polled, a file is complete once its size and
+    modification time have not changed for ``settle_time``, so files are
+    yielded at most ``settle_time + poll_interval`` after they are written.
+
+    Parameters
+    ----------
+    directory : str, optional
+        The directory to watch. Defaults to the current directory.
+    poll_interval : float, optional
+        The time between polls in seconds. Defaults to 1.
+    settle_time : float, optional
+        The time in seconds a file must be unchanged to be complete, if None
+        use ``poll_interval``. Defaults to None
+    timeout : float, optional
+        Stop after this many seconds without a new file, if None watch
+        forever. Defaults to None
+    done : container of str, optional
+        The files to skip, eg a ``Manifest``. Defaults to no files.
+
+    Yields
+    ------
+    filename : str
+        The image file
+    """
+    if settle_time is None:
+        settle_time = poll_interval
+    seen = set()
+    # the size and modification time of the incomplete files, with the time
+    # they were first seen as such
+    stats = {}
+    last_new = time.monotonic()
+    while True:
+        for name in sorted(os.listdir(directory)):
+            filename = os.path.join(directory, name)
+            if filename in seen or not is_image_file(name):
+                continue
+            if filename in done:
+                seen.add(filename)
+                continue
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            now = time.monotonic()
+            stat = (st.st_size, st.st_mtime)
+            if filename not in stats or stats[filename][0] != stat:
+                stats[filename] = (stat, now)
+            elif st.st_size and now - stats[filename][1] >= settle_time:
+                seen.add(filename)
+                del stats[filename]
+                last_new = now
+                yield filename
+        if timeout is not None and time.monotonic() - last_new > timeout:
+            return
+        time.sleep(poll_interval)
+
+
+def process_files(
+    img_filenames,
+    reader,
+    poni_file,
+    bg_file,
+    settings,
+    _output_sinks=True,
+    prefetch=4,
+    manifest=None,
+    hdf5_file=None,
+    flush_interval=10.,
+    write_queue=16,
+    dedup_masks=True,
+    frame_batch=8,
+):
+    """Process image files, in order, through a new pipeline
+
+    Parameters
+    ----------
+    img_filenames : iterable of str
+        The image files
+    reader : callable
+        Reads an image file, or the ``FrameStack`` of a multi frame file.
+        The frames of a file are processed as images named
+        ``<file>_<frame>``.
+    poni_file : str
+        The calibration file
+    bg_file : str or None
+        The background image file, if None no background is subtracted
+    settings : dict
+        The 'polarization', 'bg_scale', 'mask_kwargs' and 'mask_setting' for
+        the pipeline, and optionally the 'outputs' to write and whether to
+        'pack_masks'
+    _output_sinks : bool, optional
+        If True return the outputs. Defaults to True.
+    prefetch : int, optional
+        The number of files read ahead of the processing, the images are
+        decoded into the arrays of the images already processed.
+        Defaults to 4.
+    manifest : Manifest, optional
+        Records each file and its outputs once it is processed, if None
+        nothing is recorded. Defaults to None.
+    hdf5_file : str, optional
+        The HDF5 file to append the outputs to, if None each output is
+        written to its own file. Defaults to None.
+    flush_interval : float, optional
+        The time in seconds between flushes of the HDF5 file. Defaults to
+        10.
+    write_queue : int, optional
+        The number of writes which can wait for the background writer
+        thread, if 0 the files are written as the results are computed.
+        Defaults to 16.
+    dedup_masks : bool, optional
+        If True a mask which is the same as the last one written is only
+        referenced, see ``MaskWriter``. Defaults to True.
+    frame_batch : int, optional
+        The number of frames read from a multi frame file at once, see
+        ``iter_frames``. Defaults to 8.
+
+    Returns
+    -------
+    tuple :
+        The lists of q, mean, median and standard deviation values, if
+        ``_output_sinks``
+    """
+    import pyFAI
+
+    outputs = settings.get("outputs")
+    writer = None
+    if hdf5_file is not None:
+        writer = HDF5Writer(hdf5_file, flush_interval)
+    async_writer = None
+    if write_queue:
+        async_writer = AsyncWriter(write_queue)
+    pack_masks = settings.get("pack_masks", False)
+    # the files written for each image, for the manifest
+    written_files = None if manifest is None else WrittenFiles()
+    mask_writer = MaskWriter(writer, pack_masks, dedup_masks, written_files)
+    ns = make_pipeline(
+        _output_sinks,
+        outputs,
+        writer,
+        async_writer,
+        mask_writer,
+        written_files,
     )
-    # If running from a terminal don't output stuff into lists (too much mem)
-    return locals()
+
+    def record(filename, bases):
+        files = written_files.pop(bases)
+        # a file with a failed write is processed again on the next run
+        if files is None:
+            return
+        if writer is not None:
+            # the data is on disk before the image is done
+            writer.flush()
+            files = [hdf5_file]
+        manifest.add(filename, files)
+
+    ns["polarization_array"].args = (settings["polarization"],)
+    ns["mask_kwargs"].update(settings["mask_kwargs"])
+    ns["mask_setting"].update(settings["mask_setting"])
+
+    geo = pyFAI.load(poni_file)
+
+    bg = None
+    if bg_file is not None:
+        bg = read_file(bg_file)
+        if isinstance(bg, FrameStack):
+            # a multi frame background is averaged
+            frames = bg
+            bg = frames.read(0, len(frames)).mean(axis=0)
+            frames.close()
+        bg = bg.astype(float)
+
+    for k in ns.get("out_tup", []):
+        k.clear()
+
+    ok = False
+    try:
+        ns["geometry"].emit(geo)
+
+        # the images are corrected into a buffer of their own, so the read
+        # buffers can be reused
+        images = prefetch_images(
+            img_filenames, reader, prefetch, reuse_buffers=True
+        )
+        frame_bases = []
+        corrected = None
+        # the "first" mask setting masks the image counted as 1
+        count = settings["mask_setting"].get("setting") == "first"
+        for i, (fn, name, img, last) in enumerate(
+            iter_frames(images, frame_batch), 1
+        ):
+            ns["filename_source"].emit(name)
+            if count:
+                ns["img_counter"].emit(i)
+            if corrected is None or corrected.shape != img.shape:
+                # the binner and polarization are made once for each shape
+                ns["img_shape"].emit(img.shape)
+                pol = generate_polarization(
+                    geo, img.shape, settings["polarization"]
+                )
+                corrected = np.empty(img.shape)
+            # background subtract and polarization correct in one pass, the
+            # pipeline only holds on to the latest image so the buffer is
+            # reused
+            correct_image(
+                img,
+                bg=bg,
+                bg_scale=settings["bg_scale"],
+                polarization=pol,
+                out=corrected,
+            )
+            ns["pol_corrected_img"].emit(corrected)
+            if manifest is None:
+                continue
+            frame_bases.append(os.path.splitext(name)[0])
+            if last:
+                # after the writes of all the frames of the file, so only
+                # the files which were written are recorded
+                if async_writer is not None:
+                    async_writer.submit(record, fn, frame_bases)
+                else:
+                    record(fn, frame_bases)
+                frame_bases = []
+        ok = True
+    finally:
+        try:
+            destroy_pipeline(ns["dark_corrected_foreground"])
+            # finish the writes before closing the file they go to
+            if async_writer is not None:
+                try:
+                    stats = async_writer.close()
+                except Exception:
+                    # don't hide the error of the run with a write error
+                    if ok:
+                        raise
+                    stats = async_writer.stats()
+                print(
+                    "{written} writes, {mean_latency:.3f}s mean and "
+                    "{max_latency:.3f}s max latency, "
+                    "{max_depth} max queue depth".format(**stats)
+                )
+        finally:
+            # the file is closed even if a write failed
+            if writer is not None:
+                writer.close()
+    res = tuple([tuple(x) for x in ns.get("out_tup", [])])
+    del ns
+    return res
 
 
 def make_main(_output_sinks):
@@ -100,6 +1217,22 @@ def make_main(_output_sinks):
         mask_settings="auto",
         flip_input_mask=True,
         bg_scale=1,
+        mask_workers=None,
+        workers=None,
+        prefetch=4,
+        watch=False,
+        poll_interval=1.,
+        settle_time=None,
+        watch_timeout=None,
+        manifest_file=None,
+        outputs=None,
+        hdf5_file=None,
+        flush_interval=10.,
+        write_queue=16,
+        pack_masks=False,
+        dedup_masks=True,
+        frame_batch=8,
+        hdf5_dataset=None,
     ):
         """Run the data processing protocol taking raw images to background
         subtracted I(Q) files.
@@ -139,9 +1272,10 @@ def make_main(_output_sinks):
         alpha: float, optional
             Number of standard deviations away from the ring mean to mask,
             defaults to 3. if None do not apply automated masking
-        auto_type : {'median', 'mean'}, optional
+        auto_type : {'median', 'mean', 'segmented_median'}, optional
             The type of automasking to use, median is faster, mean is more
-            accurate. Defaults to 'median'.
+            accurate, segmented_median gives the median mask in a single
+            compiled pass. Defaults to 'median'.
         mask_settings: {'auto', 'first', none}, optional
             If auto mask every image, if first only mask first image, if None
             mask no images. Defaults to None
@@ -151,6 +1285,84 @@ def make_main(_output_sinks):
         bg_scale : float, optional
             The scale for the image to image background subtraction, defaults
             to 1
+        mask_workers : int, optional
+            The number of threads used for automated masking, if None use the
+            number of CPUs. Defaults to None
+        workers : int, optional
+            The number of processes to process the files with, each process
+            runs its own pipeline over a contiguous block of the files. The
+            geometry derived arrays are computed once and loaded (memory
+            mapped) from the geometry cache by the processes. If None or 1
+            the files are processed in this process. Defaults to None
+        prefetch : int, optional
+            The number of files read ahead of the processing on a thread
+            pool, if 0 each file is read when it is needed. Defaults to 4
+        watch : bool, optional
+            If True keep running, processing the new images in the current
+            working directory as they are written, with the pipeline built
+            once. Defaults to False
+        poll_interval : float, optional
+            The time between looking for new images in watch mode, in
+            seconds. Images are processed at most ``settle_time`` plus a
+            poll interval after they are written. Defaults to 1.
+        settle_time : float, optional
+            The time in seconds an image's size and modification time must
+            be unchanged before it is processed in watch mode, so images
+            which are still being written are not read. If None use
+            ``poll_interval``. Defaults to None
+        watch_timeout : float, optional
+            Stop watching after this many seconds without a new image, if
+            None watch until interrupted. Defaults to None
+        manifest_file : str, optional
+            File recording the processed images with their size,
+            modification time and hash and the processing parameters.
+            Images which are unchanged since they were processed with the
+            same parameters, and whose outputs exist, are not processed
+            again. Resuming an interrupted run or watch needs a manifest,
+            without one every image is processed again. With an HDF5 file
+            the file is flushed before each image is recorded. If None
+            nothing is recorded. Defaults to None
+        outputs : str or list of str, optional
+            The outputs to write, a comma separated list of 'mean',
+            'median', 'std', 'mask' and 'zscore'. The statistics and z
+            scores which are not written are not computed, the median and
+            standard deviation lists are empty if they are not written. If
+            None write all the outputs. Defaults to None
+        hdf5_file : str, optional
+            Append the outputs of all the images to this HDF5 file, instead
+            of writing files for each image, see ``xpdtools.hdf5.read_hdf5``
+            for reading them. With workers each process writes its own file,
+            numbered by its block of images. If None write files for each
+            image. Defaults to None
+        flush_interval : float, optional
+            The time in seconds between flushes of the HDF5 file, with a
+            manifest the file is also flushed before each image is recorded.
+            Defaults to 10.
+        write_queue : int, optional
+            The number of writes which can wait for the background thread
+            writing the outputs, so the processing of the next image does
+            not wait on the file system. If 0 the outputs are written as
+            they are computed. Defaults to 16
+        pack_masks : bool, optional
+            If True write the numpy masks bit packed, 8 pixels per byte, as
+            ``_mask.npz`` files, see ``xpdtools.tools.load_mask``. Defaults
+            to False
+        dedup_masks : bool, optional
+            If True a mask which is the same as the last mask written is not
+            written again, its files are hard links to the files of that
+            mask (in HDF5 the image references the row of that mask).
+            Defaults to True
+        frame_batch : int, optional
+            The number of frames read at once from a multi frame file (a
+            multi page tiff, an HDF5 or NeXus stack or a multi frame fabio
+            image). Each frame is processed on its own and its outputs are
+            named ``<file>_<frame>``, so at most a batch of frames is held
+            in memory, uncompressed contiguous stacks are memory mapped
+            instead of copied. Defaults to 8
+        hdf5_dataset : str, optional
+            The path of the stack of images in the HDF5 and NeXus input
+            files. If None the first three dimensional dataset of each file
+            is used. Defaults to None
 
         Returns
         -------
@@ -165,10 +1377,6 @@ def make_main(_output_sinks):
         """
         import pyFAI
 
-        ns = make_pipeline(_output_sinks)
-
-        ns["polarization_array"].args = (polarization,)
-        ns["dark_corrected_background"].args = (bg_scale,)
         if mask_file:
             if mask_file.endswith(".msk"):
                 # TODO: may need to flip this?
@@ -181,16 +1389,23 @@ def make_main(_output_sinks):
             tmsk = None
 
         # update all the kwargs
-        ns["mask_kwargs"].update(
-            tmsk=tmsk,
-            edge=edge,
-            lower_thresh=lower_thresh,
-            upper_thresh=upper_thresh,
-            alpha=alpha,
-            auto_type=auto_type,
+        settings = dict(
+            polarization=polarization,
+            bg_scale=bg_scale,
+            mask_kwargs=dict(
+                tmsk=tmsk,
+                edge=edge,
+                lower_thresh=lower_thresh,
+                upper_thresh=upper_thresh,
+                alpha=alpha,
+                auto_type=auto_type,
+                max_workers=mask_workers,
+            ),
+            mask_setting=dict(setting=mask_settings),
+            outputs=parse_outputs(outputs),
+            pack_masks=pack_masks,
         )
-        print(ns["mask_kwargs"])
-        ns["mask_setting"].update(setting=mask_settings)
+        print(settings["mask_kwargs"])
 
         # Load calibration
         if poni_file is None:
@@ -199,56 +1414,102 @@ def make_main(_output_sinks):
                 raise RuntimeError("There can only be one poni file")
             else:
                 poni_file = poni_file[0]
-        geo = pyFAI.load(poni_file)
-
-        bg = None
-        img_filenames = None
 
-        if image_files is None:
-            img_filenames = [
-                i
-                for i in os.listdir(".")
-                if os.path.splitext(i)[-1] in img_extensions
-            ]
-            # TODO: Test non tiff files
-            if all(
-                [
-                    f.endswith(".tiff") or f.endswith(".tif")
-                    for f in img_filenames
-                ]
-            ):
-                imgs = (tifffile.imread(i) for i in img_filenames)
-            else:
-                imgs = (
-                    fabio.open(i).data.astype(float)
-                    for i in os.listdir(".")
-                    if os.path.splitext(i)[-1] in img_extensions
-                )
-        else:
-            if isinstance(image_files, str):
-                image_files = (image_files,)
-                img_filenames = image_files
-            imgs = (fabio.open(i).data.astype(float) for i in image_files)
+        manifest = None
+        done = ()
+        if manifest_file:
+            manifest = done = Manifest(
+                manifest_file,
+                settings_fingerprint(settings, poni_file, bg_file),
+            )
+        if watch:
+            # the files are read as they arrive, so there is nothing to
+            # prefetch
+            return process_files(
+                watch_images(
+                    ".", poll_interval, settle_time, watch_timeout, done
+                ),
+                partial(read_file, dataset=hdf5_dataset),
+                poni_file,
+                bg_file,
+                settings,
+                _output_sinks,
+                0,
+                manifest,
+                hdf5_file,
+                flush_interval,
+                write_queue,
+                dedup_masks,
+                frame_batch,
+            )
 
-        if bg_file is not None:
-            bg = fabio.open(bg_file).data.astype(float)
+        img_filenames, reader = find_images(image_files)
+        if hdf5_dataset is not None:
+            reader = partial(read_file, dataset=hdf5_dataset)
+        img_filenames = [f for f in img_filenames if f not in done]
 
-        for k in ns.get("out_tup", []):
-            k.clear()
+        if not workers or workers == 1 or len(img_filenames) < 2:
+            return process_files(
+                img_filenames,
+                reader,
+                poni_file,
+                bg_file,
+                settings,
+                _output_sinks,
+                prefetch,
+                manifest,
+                hdf5_file,
+                flush_interval,
+                write_queue,
+                dedup_masks,
+                frame_batch,
+            )
 
-        ns["geometry"].emit(geo)
+        # compute the geometry derived arrays once, the workers load them
+        # from the geometry cache
+        geo = pyFAI.load(poni_file)
+        data = reader(img_filenames[0])
+        img_shape = data.shape[-2:]
+        if isinstance(data, FrameStack):
+            data.close()
+        generate_binner(geo, img_shape)
+        generate_polarization_terms(geo, img_shape)
 
-        for i, (fn, img) in enumerate(zip(img_filenames, imgs)):
-            ns["filename_source"].emit(fn)
-            if bg is None:
-                bg = np.zeros(img.shape)
-            ns["dark_corrected_background"].emit(bg)
-            ns["dark_corrected_foreground"].emit(img)
-
-        destroy_pipeline(ns["dark_corrected_foreground"])
-        res = tuple([tuple(x) for x in ns.get("out_tup", [])])
-        del ns
-        return res
+        # contiguous blocks keep the outputs in file order
+        blocks = [
+            list(b)
+            for b in np.array_split(img_filenames, workers)
+            if len(b)
+        ]
+        hdf5_files = repeat(None)
+        if hdf5_file is not None:
+            base, ext = os.path.splitext(hdf5_file)
+            hdf5_files = [
+                "{}_{}{}".format(base, i, ext) for i in range(len(blocks))
+            ]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(
+                pool.map(
+                    process_files,
+                    blocks,
+                    repeat(reader),
+                    repeat(poni_file),
+                    repeat(bg_file),
+                    repeat(settings),
+                    repeat(_output_sinks),
+                    repeat(prefetch),
+                    repeat(manifest),
+                    hdf5_files,
+                    repeat(flush_interval),
+                    repeat(write_queue),
+                    repeat(dedup_masks),
+                    repeat(frame_batch),
+                )
+            )
+        return tuple(
+            tuple(x for r in results for x in r[i])
+            for i in range(len(results[0]))
+        )
 
     return main
 
@@ -0,0 +1,164 @@
+"""Store the per image results of a run in a single HDF5 file"""
+##############################################################################
+#
+# xpdtools            by Billinge Group
+#                   Simon J. L. Billinge sb2896@columbia.edu
+#                   (c) 2017 trustees of Columbia University in the City of
+#                        New York.
+#                   All rights reserved
+#
+# File coded by:    Christopher J. Wright
+#
+# See AUTHORS.txt for a list of people who contributed.
+# See LICENSE.txt for license information.
+#
+##############################################################################
+import time
+
+import numpy as np
+
+
+class HDF5Writer(object):
+    """Append the results of each image to chunked, compressed datasets
+
+    Each output is a group of datasets with one row per image, eg the
+    ``mean`` group holds ``data``, ``q`` and ``filename`` datasets. The
+    datasets are created on the first write and grow along the first axis.
+
+    Parameters
+    ----------
+    filename : str
+        The HDF5 file, it is appended to if it exists
+    flush_interval : float, optional
+        The time in seconds between flushes of the file to disk, if 0 flush
+        after every write. Defaults to 10.
+    compression : str, optional
+        The compression of the datasets, floating point images are not
+        compressed. Defaults to "gzip".
+    compression_opts : int, optional
+        The compression level. Defaults to 1.
+    rows_per_chunk : int, optional
+        The number of rows in the chunks of the one dimensional results,
+        the chunks of images hold a single row. Defaults to 64.
+
+    Attributes
+    ----------
+    file : h5py.File
+        The HDF5 file
+    """
+
+    def __init__(
+        self,
+        filename,
+        flush_interval=10.,
+        compression="gzip",
+        compression_opts=1,
+        rows_per_chunk=64,
+    ):
+        import h5py
+
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.rows_per_chunk = rows_per_chunk
+        self.file = h5py.File(filename, "a")
+        self._string_dtype = h5py.string_dtype()
+        self._last_flush = time.monotonic()
+
+    def _dataset(self, group, name, value):
+        if name in group:
+            return group[name]
+        if isinstance(value, str):
+            return group.create_dataset(
+                name, (0,), maxshape=(None,), dtype=self._string_dtype
+            )
+        value = np.asarray(value)
+        kwargs = dict(
+            compression=self.compression,
+            compression_opts=self.compression_opts,
+            shuffle=True,
+        )
+        rows = self.rows_per_chunk
+        if value.ndim > 1:
+            rows = 1
+            # noisy floating point images barely compress, at a high cost
+            if value.dtype.kind == "f":
+                kwargs = {}
+        return group.create_dataset(
+            name,
+            (0,) + value.shape,
+            maxshape=(None,) + value.shape,
+            dtype=value.dtype,
+            chunks=(rows,) + value.shape,
+            **kwargs
+        )
+
+    def append(self, output, **data):
+        """Append a row to the datasets of an output
+
+        Parameters
+        ----------
+        output : str
+            The output, the group of the datasets
+        data : ndarray or str
+            The row of each dataset
+        """
+        group = self.file.require_group(output)
+        for name, value in data.items():
+            ds = self._dataset(group, name, value)
+            n = len(ds)
+            ds.resize(n + 1, axis=0)
+            ds[n] = value
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Flush the file to disk"""
+        self.file.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Flush and close the file"""
+        if self.file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_hdf5(filename, output=None):
+    """Read the results written by ``HDF5Writer``
+
+    Parameters
+    ----------
+    filename : str
+        The HDF5 file
+    output : str, optional
+        The output to read, if None read all the outputs. Defaults to None.
+
+    Returns
+    -------
+    dict :
+        The datasets of the output, eg ``{"data": ..., "q": ...,
+        "filename": [...]}``, or a dict of those for each output if
+        ``output`` is None
+    """
+    import h5py
+
+    def read_group(group):
+        out = {}
+        for name, ds in group.items():
+            if h5py.check_string_dtype(ds.dtype):
+                out[name] = list(ds.asstr()[()])
+            else:
+                out[name] = ds[()]
+        return out
+
+    with h5py.File(filename, "r") as f:
+        if output is not None:
+            return read_group(f[output])
+        return {k: read_group(g) for k, g in f.items()}
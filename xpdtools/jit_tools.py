@@ -46,6 +46,10 @@ def mask_ring_mean(values_array, positions_array, alpha):  # pragma: no cover
     """Find outlier pixels in a single ring via a pixel by pixel method with
     the mean.
 
+    The worst pixel is always one of the extremes of the remaining values, so
+    the values are sorted once and the sums needed for the mean and standard
+    deviation are updated as pixels are removed, making each removal O(1).
+
     Parameters
     ----------
     values_array : ndarray
@@ -60,30 +64,287 @@ def mask_ring_mean(values_array, positions_array, alpha):  # pragma: no cover
     removals: np.ndarray
         The positions of pixels to be removed from the data
     """
-    m = np.ones(positions_array.shape, dtype=boolean)
-    removals = []
-    while True:
-        b = np.array(
-            [item in removals for item in positions_array], dtype=boolean
-        )
-        m[b] = False
-        v = values_array[m]
-        if len(v) <= 1:
+    n = len(values_array)
+    removals = np.empty_like(positions_array)
+    if n <= 1:
+        return removals[:0]
+    # stable sort so ties are removed in position order, as argmax would
+    order = np.argsort(values_array, kind="mergesort")
+    sv = values_array[order].astype(np.float64)
+    # shift the sums to reduce cancellation in the variance
+    shift = sv[n // 2]
+    s = 0.0
+    s2 = 0.0
+    for x in sv:
+        s += x - shift
+        s2 += (x - shift) ** 2
+    n_left = n
+    n_removed = 0
+    lo = 0
+    hi = n - 1
+    # the largest values are removed starting from the lowest position
+    top = hi
+    while top > lo and sv[top - 1] == sv[hi]:
+        top -= 1
+    top_start = top
+    while n_left > 1:
+        # all the remaining values are the same so the std is zero
+        if sv[lo] == sv[hi]:
             break
-        std = np.std(v)
-        if std == 0.0:
+        mean_shift = s / n_left
+        var = s2 / n_left - mean_shift ** 2
+        if var <= 0.0:
             break
-        norm_v_list = np.abs(v - np.mean(v)) / std
-        if np.all(norm_v_list < alpha):
+        std = np.sqrt(var)
+        mean = mean_shift + shift
+        z_lo = abs(sv[lo] - mean) / std
+        z_hi = abs(sv[top] - mean) / std
+        if z_lo < alpha and z_hi < alpha:
             break
-        # get the index of the worst pixel
-        worst_idx = np.argmax(norm_v_list)
         # add the worst position to the mask
-        removals.append(positions_array[m][worst_idx])
-    return removals
+        if z_lo > z_hi or (z_lo == z_hi and order[lo] < order[top]):
+            i = lo
+            lo += 1
+        else:
+            i = top
+            top += 1
+            if top > hi:
+                hi = top_start - 1
+                top = hi
+                while top > lo and sv[top - 1] == sv[hi]:
+                    top -= 1
+                top_start = top
+        s -= sv[i] - shift
+        s2 -= (sv[i] - shift) ** 2
+        n_left -= 1
+        removals[n_removed] = positions_array[order[i]]
+        n_removed += 1
+    return removals[:n_removed]
 
 
 @jit(cache=True, nopython=True, nogil=True)
 def ring_zscore(ring):
     ring -= np.mean(ring)
     ring /= np.std(ring)
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def mask_ring_median_segmented(
+    values_array, mask_array, counts, alpha
+):  # pragma: no cover
+    """Find outlier pixels in every ring via a single pass with the median.
+
+    This is equivalent to running ``mask_ring_median`` over each ring, but
+    walks the ring segments of the sorted image in one compiled loop.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The image values sorted by ring
+    mask_array : ndarray
+        The prior mask sorted by ring, True pixels are used
+    counts : ndarray
+        The number of pixels in each ring
+    alpha: float
+        The threshold
+
+    Returns
+    -------
+    removals: np.ndarray
+        Boolean array (in ring order) which is True for pixels to be removed
+        from the data
+    """
+    removals = np.zeros(values_array.shape, dtype=boolean)
+    i = 0
+    for k in counts:
+        if k > 0:
+            m = mask_array[i : i + k]
+            vm = values_array[i : i + k][m]
+            if len(vm) > 0:
+                z = np.abs(vm - np.median(vm)) / np.std(vm)
+                good = np.where(m)[0]
+                for j in range(len(vm)):
+                    if z[j] > alpha:
+                        removals[i + good[j]] = True
+        i += k
+    return removals
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def ring_stats(values_array, counts, percentiles):  # pragma: no cover
+    """Compute the statistics of every ring in one pass over the sorted
+    image.
+
+    The mean and standard deviation come from the running sums of each ring,
+    the median from a selection or, if percentiles are requested, from
+    sorting the ring once.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The image values sorted by ring
+    counts : ndarray
+        The number of pixels in each ring
+    percentiles : ndarray
+        The percentiles to compute, in [0, 100]
+
+    Returns
+    -------
+    mean : np.ndarray
+        The mean of each ring, NaN for empty rings
+    median : np.ndarray
+        The median of each ring, NaN for empty rings
+    std : np.ndarray
+        The standard deviation of each ring, zero for empty rings
+    pct : np.ndarray
+        The percentiles (linearly interpolated) of each ring, shaped
+        (number of percentiles, number of rings), NaN for empty rings
+    """
+    n = len(counts)
+    mean = np.full(n, np.nan)
+    median = np.full(n, np.nan)
+    std = np.zeros(n)
+    pct = np.full((len(percentiles), n), np.nan)
+    i = 0
+    for r in range(n):
+        k = counts[r]
+        if k > 0:
+            ring = values_array[i : i + k]
+            # shift the sums to reduce cancellation in the variance
+            shift = ring[0]
+            s = 0.
+            s2 = 0.
+            for v in ring:
+                s += v - shift
+                s2 += (v - shift) ** 2
+            m = s / k
+            mean[r] = m + shift
+            std[r] = np.sqrt(max(s2 / k - m * m, 0.))
+            if len(percentiles) == 0:
+                # a selection is cheaper than a sort for the median alone
+                median[r] = np.median(ring)
+                i += k
+                continue
+            ring = np.sort(ring)
+            median[r] = .5 * (ring[(k - 1) // 2] + ring[k // 2])
+            for j in range(len(percentiles)):
+                pos = percentiles[j] / 100. * (k - 1)
+                lo = int(np.floor(pos))
+                hi = min(lo + 1, k - 1)
+                pct[j, r] = ring[lo] + (ring[hi] - ring[lo]) * (pos - lo)
+        i += k
+    return mean, median, std, pct
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def bin_moments(values_array, bin_array, n_bins):  # pragma: no cover
+    """Compute the mean and standard deviation of each bin in one pass over
+    the image.
+
+    The sums are taken around the first value of each bin, so the variance
+    does not lose precision when the values sit on a large offset.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The flattened image
+    bin_array : ndarray
+        The bin of each pixel
+    n_bins : int
+        The number of bins
+
+    Returns
+    -------
+    mean : np.ndarray
+        The mean of each bin, NaN for empty bins
+    std : np.ndarray
+        The standard deviation of each bin, NaN for empty bins
+    """
+    shift = np.zeros(n_bins)
+    s = np.zeros(n_bins)
+    s2 = np.zeros(n_bins)
+    counts = np.zeros(n_bins)
+    for i in range(len(values_array)):
+        b = bin_array[i]
+        v = values_array[i]
+        if counts[b] == 0:
+            shift[b] = v
+        d = v - shift[b]
+        s[b] += d
+        s2[b] += d * d
+        counts[b] += 1
+    mean = np.full(n_bins, np.nan)
+    std = np.full(n_bins, np.nan)
+    for b in range(n_bins):
+        k = counts[b]
+        if k > 0:
+            m = s[b] / k
+            mean[b] = m + shift[b]
+            std[b] = np.sqrt(max(s2[b] / k - m * m, 0.))
+    return mean, std
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def bin_zscore(
+    values_array, bin_array, mean, inv_std, out
+):  # pragma: no cover
+    """Z score each pixel by the mean and standard deviation of its bin.
+
+    Parameters
+    ----------
+    values_array : ndarray
+        The flattened image
+    bin_array : ndarray
+        The bin of each pixel
+    mean : ndarray
+        The mean of each bin
+    inv_std : ndarray
+        The inverse of the standard deviation of each bin
+    out : ndarray
+        The array to write the z scores into
+    """
+    for i in range(len(values_array)):
+        b = bin_array[i]
+        out[i] = (values_array[i] - mean[b]) * inv_std[b]
+
+
+@jit(cache=True, nopython=True, nogil=True)
+def correct_pixels(
+    fg, fg_dark, bg, bg_dark, bg_scale, polarization, out
+):  # pragma: no cover
+    """Dark subtract, background subtract and polarization correct the
+    pixels of an image in one pass.
+
+    Computes ``((fg - fg_dark) - (bg - bg_dark) * bg_scale) / polarization``,
+    any of ``fg_dark``, ``bg``, ``bg_dark`` and ``polarization`` may be None
+    to skip its step.
+
+    Parameters
+    ----------
+    fg : ndarray
+        The flattened foreground image
+    fg_dark : ndarray or None
+        The flattened foreground dark
+    bg : ndarray or None
+        The flattened background image
+    bg_dark : ndarray or None
+        The flattened background dark
+    bg_scale : float
+        The background scale
+    polarization : ndarray or None
+        The flattened polarization array
+    out : ndarray
+        The flattened array to write the corrected image into
+    """
+    for i in range(len(out)):
+        v = fg[i] * 1.
+        if fg_dark is not None:
+            v -= fg_dark[i]
+        if bg is not None:
+            b = bg[i] * 1.
+            if bg_dark is not None:
+                b -= bg_dark[i]
+            v -= b * bg_scale
+        if polarization is not None:
+            v /= polarization[i]
+        out[i] = v
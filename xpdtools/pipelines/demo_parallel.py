@@ -6,11 +6,13 @@ from rapidz import Stream
 from xpdtools.tools import (
     load_geo,
     mask_img,
-    map_to_binner,
+    mask_binner,
     fq_getter,
     pdf_getter,
     sq_getter,
     generate_map_bin,
+    generate_binner,
+    generate_polarization,
     splay_tuple,
     call_stream_element,
 )
@@ -63,7 +65,7 @@ def calibration(geo_input, img_shape, calib_setting=None, **kwargs):
     # Only create map and bins (which is expensive) when needed
     # (new calibration)
     map_res = geometry_img_shape.starmap(generate_map_bin)
-    cal_binner = map_res.starmap(map_to_binner)
+    cal_binner = geometry_img_shape.starmap(generate_binner)
     return locals()
 
 
@@ -71,10 +73,9 @@ def scattering_correction(
     geometry, img_shape, bg_corrected_img, polarization_factor=.99, **kwargs
 ):
 
-    polarization_callable = geometry.map(getattr, "polarization")
-
-    polarization_array = polarization_callable.zip_latest(img_shape).starmap(
-        call_stream_element, polarization_factor
+    # the polarization arrays are cached for each geometry, shape and factor
+    polarization_array = geometry.zip_latest(img_shape).starmap(
+        generate_polarization, polarization_factor
     )
 
     pol_correction_combine = bg_corrected_img.combine_latest(
@@ -108,18 +109,14 @@ def gen_mask(pol_corrected_img, cal_binner, mask_kwargs=None, **kwargs):
 
 
 def integration(
-    map_res,
+    cal_binner,
     mask,
     # wavelength,
     pol_corrected_img,
     **kwargs
 ):
     # Integration
-    binner = (
-        map_res.combine_latest(mask, emit_on=1)
-        .map(splay_tuple)
-        .starmap(map_to_binner)
-    )
+    binner = cal_binner.combine_latest(mask, emit_on=1).starmap(mask_binner)
     q = binner.map(getattr, "bin_centers", stream_name="Q")
     # tth = (
     #     q.combine_latest(wavelength, emit_on=0)
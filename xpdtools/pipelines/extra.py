@@ -1,7 +1,12 @@
 import operator as op
 
 import numpy as np
-from xpdtools.tools import z_score_image, overlay_mask, call_stream_element
+from xpdtools.tools import (
+    z_score_image,
+    overlay_mask,
+    call_stream_element,
+    binned_statistics,
+)
 
 
 def median_gen(f_img_binner, **kwargs):
@@ -18,10 +23,56 @@ def std_gen(f_img_binner, mean, **kwargs):
     return locals()
 
 
-def z_score_gen(pol_corrected_img, binner, mask, **kwargs):
+def stats_gen(pol_corrected_img, binner, mean, percentiles=None, **kwargs):
+    """Pipeline chunk for the median, standard deviation and percentiles of
+    each bin, computed in a single pass over the image
+
+    This replaces ``median_gen`` and ``std_gen``.
+
+    Parameters
+    ----------
+    pol_corrected_img : Stream
+    binner : Stream
+    mean : Stream
+    percentiles : sequence of float, optional
+        The percentiles (in [0, 100]) to compute, if None none are computed.
+        Defaults to None.
+
+    Returns
+    -------
+    ns : dict
+        The namespace created by the chunk
+    """
+    stats_input = pol_corrected_img.combine_latest(binner, emit_on=0)
+    binned_stats = stats_input.starmap(
+        binned_statistics, percentiles=percentiles, stream_name="binned stats"
+    )
+    # the image and binner with their statistics, for ``z_score_gen``
+    img_binner_stats = stats_input.zip(binned_stats).map(
+        lambda x: (*x[0], x[1])
+    )
+    median = binned_stats.pluck("median").map(np.nan_to_num)
+    std = (
+        binned_stats.pluck("std")
+        .combine_latest(mean, emit_on=0)
+        .starmap(op.truediv)
+        .map(np.nan_to_num)
+    )
+    percentile = binned_stats.pluck("percentiles")
+    return locals()
+
+
+def z_score_gen(
+    pol_corrected_img, binner, mask, img_binner_stats=None, **kwargs
+):
+    if img_binner_stats is None:
+        img_binner = pol_corrected_img.combine_latest(binner, emit_on=0)
+    else:
+        # reuse the statistics of each bin from ``stats_gen``, they come
+        # with the image they were computed from
+        img_binner = img_binner_stats
     z_score = (
-        pol_corrected_img.combine_latest(binner, emit_on=0)
-        .starmap(z_score_image, stream_name="z score")
+        img_binner.starmap(z_score_image, stream_name="z score")
         .combine_latest(mask, emit_on=0)
         .starmap(overlay_mask)
     )
@@ -8,8 +8,10 @@ from xpdtools.calib import img_calibration
 from xpdtools.tools import (
     load_geo,
     mask_img,
-    map_to_binner,
+    mask_binner,
     generate_map_bin,
+    generate_binner,
+    generate_polarization,
     move_center,
 )
 
@@ -66,18 +68,16 @@ img_shape = bg_corrected_img.map(np.shape).unique(history=1)
 geometry_img_shape = geometry.zip_latest(img_shape)
 
 # Only create map and bins (which is expensive) when needed (new calibration)
-map_res = geometry_img_shape.starmap(generate_map_bin)
-cal_binner = map_res.starmap(map_to_binner)
+# every motor move gives a new geometry, so don't fill the disk cache
+map_res = geometry_img_shape.starmap(generate_map_bin, disk_cache=False)
+cal_binner = geometry_img_shape.starmap(generate_binner, disk_cache=False)
 
 bins = cal_binner.combine_latest(
     img_shape, emit_on=0, first=img_shape
 ).starmap(lambda x, y: x.binmap.reshape(y))
 
 polarization_array = geometry_img_shape.starmap(
-    lambda geo, shape, polarization_factor: geo.polarization(
-        shape, polarization_factor
-    ),
-    .99,
+    generate_polarization, .99, disk_cache=False
 )
 
 pol_correction_combine = bg_corrected_img.combine_latest(
@@ -125,11 +125,7 @@ no_mask = img_cal_binner.filter(
 mask = all_mask.union(first_mask, no_mask)
 
 # Integration
-binner = (
-    map_res.combine_latest(mask, emit_on=1)
-    .map(lambda x: (x[0][0], x[0][1], x[1]))
-    .starmap(map_to_binner)
-)
+binner = cal_binner.combine_latest(mask, emit_on=1).starmap(mask_binner)
 q = binner.map(getattr, "bin_centers", stream_name="Q")
 f_img_binner = pol_corrected_img.map(np.ravel).combine_latest(
     binner, emit_on=0
@@ -5,19 +5,21 @@ import numpy as np
 from skbeam.core.utils import q_to_twotheta
 from rapidz import Stream
 
+from xpdtools.binning import RingIndex
 from xpdtools.calib import img_calibration
 from xpdtools.tools import (
     load_geo,
     mask_img,
-    map_to_binner,
-    fq_getter,
-    pdf_getter,
-    sq_getter,
+    mask_binner,
+    cached_sq_fq_pdf_getter,
     generate_map_bin,
+    generate_polarization,
+    generate_binner,
     pluck_check,
     splay_tuple,
     call_stream_element,
     check_kwargs,
+    correct_image,
 )
 
 namespace = dict(
@@ -146,12 +148,21 @@ def calibration(
     # Only create map and bins (which is expensive) when needed
     # (new calibration)
     map_res = geometry_img_shape.starmap(generate_map_bin)
-    cal_binner = map_res.starmap(map_to_binner)
+    # generate_binner loads the bin assignment from the cache when possible
+    cal_binner = geometry_img_shape.starmap(generate_binner)
+    # The ring partition of the pixels, shared by the per ring routines
+    ring_index = cal_binner.map(RingIndex.from_binner)
     return locals()
 
 
 def scattering_correction(
-    geometry, img_shape, bg_corrected_img, polarization_factor=.99, **kwargs
+    geometry,
+    img_shape,
+    raw_foreground,
+    raw_foreground_dark,
+    dark_corrected_background,
+    polarization_factor=.99,
+    **kwargs
 ):
     """Pipeline chunk for performing scattering corrections on images,
     including the polarization correction.
@@ -160,7 +171,9 @@ def scattering_correction(
     ----------
     geometry : Stream
     img_shape : Stream
-    bg_corrected_img : Stream
+    raw_foreground : Stream
+    raw_foreground_dark : Stream
+    dark_corrected_background : Stream
     polarization_factor : float, optional
         The polarization factor used to correct the image. Defaults to .99
 
@@ -168,24 +181,39 @@ def scattering_correction(
     -------
     ns : dict
         The namespace created by the chunk
-    """
 
-    polarization_callable = geometry.map(getattr, "polarization")
+    Notes
+    -----
+    The dark subtraction, background subtraction and polarization
+    correction of each image are done in a single ``correct_image`` pass,
+    ``bg_corrected_img`` is only used for calibration and the image shape.
+    """
 
-    polarization_array = polarization_callable.zip_latest(img_shape).starmap(
-        call_stream_element, polarization_factor
+    # the polarization arrays are cached for each geometry, shape and factor
+    polarization_array = geometry.zip_latest(img_shape).starmap(
+        generate_polarization, polarization_factor
     )
 
-    pol_correction_combine = bg_corrected_img.combine_latest(
-        polarization_array, emit_on=bg_corrected_img
+    # the foreground reaches image_process first, so the polarization array
+    # for the shape of the image is in place when this emits
+    pol_correction_combine = raw_foreground.combine_latest(
+        raw_foreground_dark,
+        dark_corrected_background,
+        polarization_array,
+        emit_on=raw_foreground,
+    )
+    pol_corrected_img = pol_correction_combine.starmap(
+        lambda fg, fg_dark, bg, pol: correct_image(
+            fg, fg_dark, bg, polarization=pol
+        ),
+        stream_name="pol corrected img",
     )
-    pol_corrected_img = pol_correction_combine.starmap(op.truediv)
     return locals()
 
 
 def gen_mask(
     pol_corrected_img,
-    cal_binner,
+    ring_index,
     img_counter,
     mask_setting=None,
     mask_kwargs=None,
@@ -196,7 +224,8 @@ def gen_mask(
     Parameters
     ----------
     pol_corrected_img : Stream
-    cal_binner : Stream
+    ring_index : Stream
+        The stream of ``RingIndex`` for the unmasked detector
     img_counter : Stream
     mask_setting : dict, optional
         The setting for the frequency of the mask. If set to
@@ -208,7 +237,9 @@ def gen_mask(
     mask_kwargs : dict, optional
         The keyword arguments passed to ``xpdtools.tools.mask_img``.
         Defaults to ``dict(edge=30, lower_thresh=0.0, upper_thresh=None,
-         alpha=3, auto_type="median", tmsk=None,)``
+         alpha=3, auto_type="median", tmsk=None, max_workers=None)``.
+        ``max_workers`` sizes the process wide masking pool (None uses the
+        number of CPUs), a dedicated ``pool`` may also be passed.
 
     Returns
     -------
@@ -224,6 +255,7 @@ def gen_mask(
             alpha=3,
             auto_type="median",
             tmsk=None,
+            max_workers=None,
         )
     if mask_setting is None:
         mask_setting = {"setting": "auto"}
@@ -232,7 +264,7 @@ def gen_mask(
     # comes after the geometry itself, so we never have a condition where
     # we fail to emit because pol_corrected_img comes down first
     img_cal_binner = pol_corrected_img.combine_latest(
-        cal_binner, emit_on=pol_corrected_img
+        ring_index, emit_on=pol_corrected_img
     )
 
     all_mask_filter = img_cal_binner.filter(
@@ -279,12 +311,14 @@ def gen_mask(
     return locals()
 
 
-def integration(map_res, mask, wavelength, pol_corrected_img, **kwargs):
+def integration(cal_binner, mask, wavelength, pol_corrected_img, **kwargs):
     """Pipeline chunk for computing azimuthal integration
 
     Parameters
     ----------
-    map_res : Stream
+    cal_binner : Stream
+        The stream of unmasked binners, the masks are applied to it without
+        binning the pixels again
     mask : Stream
     wavelength : Stream
     pol_corrected_img : Stream
@@ -295,11 +329,7 @@ def integration(map_res, mask, wavelength, pol_corrected_img, **kwargs):
         The namespace created by the chunk
     """
     # Integration
-    binner = (
-        map_res.combine_latest(mask, emit_on=1)
-        .map(splay_tuple)
-        .starmap(map_to_binner)
-    )
+    binner = cal_binner.combine_latest(mask, emit_on=1).starmap(mask_binner)
     q = binner.map(getattr, "bin_centers", stream_name="Q")
     tth = (
         q.combine_latest(wavelength, emit_on=0)
@@ -343,24 +373,19 @@ def pdf_gen(q, mean, composition, **kwargs):
     iq_comp_map = iq_comp.map(splay_tuple)
 
     # TODO: split these all up into their components ((r, pdf), (q, fq)...)
-    sq = iq_comp_map.starmap(
-        sq_getter,
-        stream_name="sq",
-        **(dict(dataformat="QA", qmaxinst=28, qmax=25))
-    )
-    fq = iq_comp_map.starmap(
-        fq_getter,
-        stream_name="fq",
-        **(dict(dataformat="QA", qmaxinst=28, qmax=25))
-    )
-    pdf = iq_comp_map.starmap(
-        pdf_getter,
-        stream_name="pdf",
-        **(dict(dataformat="QA", qmaxinst=28, qmax=22))
+    # PDFGetter runs once for all three when the kwargs allow it, and not at
+    # all for inputs which are in ``xpdtools.cache.pdf_cache``
+    sq_fq_pdf = iq_comp_map.starmap(
+        cached_sq_fq_pdf_getter,
+        stream_name="sq fq pdf",
+        fq_kwargs=dict(dataformat="QA", qmaxinst=28, qmax=25),
+        pdf_kwargs=dict(dataformat="QA", qmaxinst=28, qmax=22),
     )
-    fq_kwargs = fq.kwargs
-    sq.kwargs = fq_kwargs
-    pdf_kwargs = pdf.kwargs
+    sq = sq_fq_pdf.pluck(0, stream_name="sq")
+    fq = sq_fq_pdf.pluck(1, stream_name="fq")
+    pdf = sq_fq_pdf.pluck(2, stream_name="pdf")
+    fq_kwargs = sq_fq_pdf.kwargs["fq_kwargs"]
+    pdf_kwargs = sq_fq_pdf.kwargs["pdf_kwargs"]
 
     return locals()
 
@@ -2,9 +2,22 @@ import pytest
 
 import tempfile
 
+from xpdtools import cache
+
 
 @pytest.fixture(scope="function")
 def fast_tmpdir():
     td = tempfile.TemporaryDirectory()
     yield td.name
     td.cleanup()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def geometry_cache(monkeypatch):
+    """Keep the geometry disk cache of each test in a temporary directory,
+    so the tests neither depend on nor fill the user's cache"""
+    td = tempfile.TemporaryDirectory()
+    monkeypatch.setenv("XPDTOOLS_CACHE_DIR", td.name)
+    monkeypatch.setattr(cache, "geometry_cache", cache.DiskCache(td.name))
+    yield cache.geometry_cache
+    td.cleanup()
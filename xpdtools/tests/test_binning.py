@@ -0,0 +1,65 @@
+import numpy as np
+from numpy.testing import assert_equal, assert_allclose
+
+from xpdtools.binning import PrecomputedBinner, RingIndex
+from xpdtools.tests.utils import pyFAI_calib
+from xpdtools.tools import (
+    load_geo,
+    map_to_binner,
+    mask_binner,
+    generate_map_bin,
+    binned_outlier,
+)
+
+geo = load_geo(pyFAI_calib)
+shape = (2048, 2048)
+# made at import, outside of the per test geometry cache
+q, qbin = generate_map_bin(geo, shape, disk_cache=False)
+binner = map_to_binner(q, qbin)
+
+
+def test_ring_index():
+    ri = RingIndex.from_binner(binner)
+    assert_equal(ri.flatcount, binner.flatcount)
+    assert_equal(ri.positions, binner.argsort_index)
+    assert_equal(ri.offsets[-1], np.prod(shape))
+    assert ri.positions.dtype == np.int32
+    img = np.random.random(shape)
+    vfs = ri.gather(img)
+    for j in [1, 100, 1000]:
+        s, e = ri.offsets[j], ri.offsets[j + 1]
+        assert_equal(np.sort(vfs[s:e]), np.sort(img.ravel()[binner.xy == j]))
+
+
+def test_ring_index_with_mask():
+    mask = np.random.randint(0, 2, np.prod(shape), dtype=bool).reshape(shape)
+    ri = RingIndex.from_binner(binner, mask=mask)
+    b = map_to_binner(q, qbin, mask=mask)
+    assert_equal(ri.bin_index, b.xy)
+    assert_equal(ri.flatcount[: len(b.flatcount)], b.flatcount)
+    assert_equal(ri.bin_index[ri.positions], np.sort(b.xy))
+
+
+def test_binned_outlier_ring_index():
+    img = np.random.normal(100, 10, shape)
+    ri = RingIndex.from_binner(binner)
+    assert_equal(
+        binned_outlier(img, binner, mask_method="segmented_median"),
+        binned_outlier(img, ri, mask_method="segmented_median"),
+    )
+
+
+def test_mask_binner():
+    mask = np.random.randint(0, 2, np.prod(shape), dtype=bool).reshape(shape)
+    b = map_to_binner(q, qbin, mask=mask)
+    mb = mask_binner(binner, mask)
+    assert isinstance(mb, PrecomputedBinner)
+    assert_equal(mb.xy, b.xy)
+    assert_equal(mb.flatcount, b.flatcount)
+    assert_equal(mb.xy[mb.argsort_index], np.sort(b.xy))
+    img = np.random.random(shape).ravel()
+    for statistic in ["mean", "median", "std"]:
+        assert_allclose(
+            mb(img, statistic=statistic), b(img, statistic=statistic)
+        )
+    assert_equal(mask_binner(binner).xy, binner.xy)
@@ -0,0 +1,225 @@
+import os
+
+import numpy as np
+import pytest
+from numpy.testing import assert_equal, assert_allclose
+
+from xpdtools import cache
+from xpdtools.binning import PrecomputedBinner
+from xpdtools.cache import (
+    DiskCache,
+    LRUCache,
+    ResultCache,
+    file_fingerprint,
+    geometry_fingerprint,
+)
+from xpdtools.tests.utils import pyFAI_calib
+from xpdtools.tools import (
+    load_geo,
+    generate_map_bin,
+    generate_binner,
+    map_to_binner,
+    generate_polarization,
+    generate_polarization_terms,
+)
+
+geo = load_geo(pyFAI_calib)
+shape = (2048, 2048)
+
+
+@pytest.fixture(scope="function")
+def disk_cache(fast_tmpdir, monkeypatch):
+    dc = DiskCache(fast_tmpdir)
+    monkeypatch.setattr(cache, "geometry_cache", dc)
+    monkeypatch.setattr(cache, "memory_cache", LRUCache())
+    yield dc
+
+
+def test_geometry_fingerprint():
+    a = geometry_fingerprint(geo, shape)
+    assert a == geometry_fingerprint(load_geo(pyFAI_calib), shape)
+    assert a != geometry_fingerprint(geo, (1024, 1024))
+    g2 = load_geo(dict(pyFAI_calib, dist=.3))
+    assert a != geometry_fingerprint(g2, shape)
+
+
+def test_file_fingerprint(fast_tmpdir):
+    fn = os.path.join(fast_tmpdir, "a.txt")
+    with open(fn, "wb") as f:
+        f.write(b"a" * 100)
+    a = file_fingerprint(fn)
+    assert a == file_fingerprint(fn, block_size=7)
+    with open(fn, "wb") as f:
+        f.write(b"a" * 99 + b"b")
+    assert a != file_fingerprint(fn)
+
+
+def test_disk_cache(fast_tmpdir):
+    dc = DiskCache(fast_tmpdir, max_bytes=2000)
+    assert dc.get("a", ["x"]) is None
+    dc.put("a", x=np.arange(100))
+    dc.put("a", y=np.ones(10))
+    out = dc.get("a", ["x", "y"])
+    assert isinstance(out["x"], np.memmap)
+    assert_equal(out["x"], np.arange(100))
+    assert not out["x"].flags.writeable
+    # make "a" the oldest entry then go over the size limit
+    os.utime(os.path.join(fast_tmpdir, "a"), (0, 0))
+    dc.put("b", x=np.arange(200))
+    assert dc.get("a", ["x"]) is None
+    assert dc.get("b", ["x"]) is not None
+    assert dc.nbytes <= dc.max_bytes
+
+
+def test_disk_cache_disabled():
+    dc = DiskCache("")
+    dc.put("a", x=np.arange(100))
+    assert dc.get("a", ["x"]) is None
+
+
+def test_generate_map_bin_cached(disk_cache):
+    q, qbin = generate_map_bin(geo, shape)
+    assert disk_cache.entries()
+    assert generate_map_bin(geo, shape)[0] is q
+    cache.memory_cache.clear()
+    q2, qbin2 = generate_map_bin(geo, shape)
+    assert isinstance(q2, np.memmap)
+    assert_equal(q, q2)
+    assert_equal(qbin, qbin2)
+
+
+def test_generate_binner_cached(disk_cache):
+    a = generate_binner(geo, shape)
+    assert generate_binner(geo, shape) is a
+    cache.memory_cache.clear()
+    b = generate_binner(geo, shape)
+    assert isinstance(b, PrecomputedBinner)
+    c = map_to_binner(*generate_map_bin(geo, shape))
+    assert_equal(b.xy, c.xy)
+    assert_equal(b.flatcount, a.flatcount)
+    assert_equal(b.argsort_index, a.argsort_index)
+    assert_equal(b.bin_centers, c.bin_centers)
+    img = np.random.random(shape).ravel()
+    for stat in ["mean", "median", "std"]:
+        assert_equal(b(img, statistic=stat), c(img, statistic=stat))
+
+
+def test_lru_cache():
+    c = LRUCache(max_bytes=200)
+    assert c.get("a") is None
+    c.put("a", np.ones(10))
+    c.put("b", np.ones(10))
+    assert c.get("a") is not None
+    # "b" is the least recently used
+    c.put("c", np.ones(10))
+    assert "b" not in c
+    assert "a" in c and "c" in c
+    assert c.nbytes == 160
+    assert (c.hits, c.misses) == (1, 1)
+    assert c.hit_rate == .5
+    # too big to keep
+    c.put("d", np.ones(100))
+    assert len(c) == 0
+    assert c.cached_call("e", np.ones, 3).shape == (3,)
+    assert c.cached_call("e", np.zeros, 3)[0] == 1
+    # the items are shared, so they can't be changed
+    assert not c.get("e").flags.writeable
+    c.put("f", (np.ones(2), [np.ones(2)]))
+    a, (b,) = c.get("f")
+    assert not a.flags.writeable and not b.flags.writeable
+
+
+def test_lru_cache_sizes(monkeypatch):
+    sized = []
+
+    def sizeof(value):
+        sized.append(value)
+        return 80
+
+    monkeypatch.setattr(cache, "sizeof", sizeof)
+    c = LRUCache(max_bytes=200)
+    for k in "abc":
+        c.put(k, k)
+    # each item is measured once, when it is added
+    assert sized == ["a", "b", "c"]
+    assert c.nbytes == 160
+    c.put("c", "c", nbytes=10)
+    assert c.nbytes == 90
+    c.clear()
+    assert c.nbytes == 0
+
+
+def test_memory_cache(disk_cache):
+    assert load_geo(pyFAI_calib) is load_geo(dict(pyFAI_calib))
+    p = generate_polarization(geo, shape, .99)
+    assert p is generate_polarization(geo, shape, .99)
+    assert not p.flags.writeable
+    assert_allclose(p, geo.polarization(shape, .99), rtol=1e-6)
+    assert generate_polarization(geo, shape, .5) is not p
+    q, _ = generate_map_bin(geo, shape)
+    assert not q.flags.writeable
+    assert cache.memory_cache.hits >= 2
+    assert cache.memory_cache.nbytes >= 2 * p.nbytes + q.nbytes
+
+
+def test_geometry_memory(disk_cache):
+    g = load_geo(pyFAI_calib)
+    assert g is not geo
+    generate_map_bin(g, shape)
+    generate_polarization_terms(g, shape)
+    # pyFAI's own copies of the arrays are dropped
+    assert cache.sizeof(g) == 0
+    # the arrays pyFAI keeps on a geometry are counted
+    q = g.qArray(shape)
+    assert cache.sizeof(g) >= q.nbytes
+    c = LRUCache(max_bytes=2 ** 20)
+    c.put("geo", g)
+    assert "geo" not in c
+    c.put("a", np.ones(10))
+    assert "a" in c
+
+
+@pytest.mark.parametrize("factor", [.99, .5, 0, -1])
+def test_generate_polarization(disk_cache, factor):
+    # pyFAI's float32 result itself moves by a few 1e-7
+    assert_allclose(
+        generate_polarization(geo, shape, factor),
+        geo.polarization(shape, factor),
+        rtol=1e-6,
+    )
+    # the terms are loaded back from the disk for a new process
+    cache.memory_cache.clear()
+    cos2_tth, _ = generate_polarization_terms(geo, shape)
+    assert isinstance(cos2_tth, np.memmap)
+    assert_allclose(
+        generate_polarization(load_geo(pyFAI_calib), shape, factor),
+        geo.polarization(shape, factor),
+        rtol=1e-6,
+    )
+
+
+def test_result_cache(fast_tmpdir):
+    calls = []
+
+    def f(x, y, scale=1):
+        calls.append(1)
+        return x * y * scale
+
+    c = ResultCache(directory=fast_tmpdir)
+    a = np.arange(10.)
+    assert_equal(c.cached_call(f, a, 2, scale=3), a * 6)
+    assert_equal(c.cached_call(f, a.copy(), 2, scale=3), a * 6)
+    assert len(calls) == 1
+    c.cached_call(f, a, 2, scale=2)
+    c.cached_call(f, a + 1, 2, scale=3)
+    assert len(calls) == 3
+    assert c.hit_rate == .25
+    # results are loaded back from the disk
+    c.memory.clear()
+    res = c.cached_call(f, a, 2, scale=3)
+    assert_equal(res, a * 6)
+    assert not res.flags.writeable
+    assert len(calls) == 3
+    c2 = ResultCache()
+    c2.cached_call(f, a, 2, scale=3)
+    assert len(calls) == 4
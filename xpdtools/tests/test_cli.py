@@ -9,10 +9,25 @@ from numpy.testing import (
     assert_allclose,
 )
 import pytest
+import tifffile
 
 from skbeam.io.fit2d import fit2d_save, read_fit2d_msk
 from xpdsim import pyfai_poni, image_file
-from xpdtools.cli.process_tiff import main, make_main
+from xpdtools.hdf5 import HDF5Writer, read_hdf5
+from xpdtools.tools import get_mask_pool, load_mask
+from xpdtools.cli import process_tiff
+from xpdtools.cli.process_tiff import (
+    FrameStack,
+    Manifest,
+    iter_frames,
+    main,
+    make_main,
+    parse_outputs,
+    prefetch_images,
+    read_file,
+    read_tiff,
+    watch_images,
+)
 
 no_output_main = make_main(False)
 
@@ -163,3 +178,446 @@ def test_main_background(fast_tmpdir):
     assert_array_equal(out[1][0], np.zeros(out[1][0].shape))
     for ext in expected_outputs:
         assert "test" + ext in files
+
+
+def test_main_bg_scale(fast_tmpdir):
+    poni_file = pyfai_poni
+    dest_image_file = str(os.path.join(fast_tmpdir, "test.tiff"))
+    shutil.copy(image_file, dest_image_file)
+    full = main(poni_file, dest_image_file)
+    # the image is corrected in one pass, with the scaled background
+    half = main(
+        poni_file, dest_image_file, bg_file=dest_image_file, bg_scale=.5
+    )
+    assert_allclose(half[1][0], full[1][0] * .5)
+
+
+def test_main_workers(fast_tmpdir):
+    poni_file = pyfai_poni
+    img_files = []
+    for i in range(3):
+        dest_image_file = str(
+            os.path.join(fast_tmpdir, "test{}.tiff".format(i))
+        )
+        shutil.copy(image_file, dest_image_file)
+        img_files.append(dest_image_file)
+    serial = main(poni_file, img_files)
+    parallel = main(poni_file, img_files, workers=2)
+    assert len(parallel[1]) == len(img_files)
+    for a, b in zip(serial, parallel):
+        for x, y in zip(a, b):
+            assert_allclose(x, y)
+    files = os.listdir(str(fast_tmpdir))
+    for i in range(3):
+        for ext in expected_outputs:
+            assert "test{}".format(i) + ext in files
+
+
+def test_main_workers_after_masking(fast_tmpdir):
+    poni_file = pyfai_poni
+    img_files = []
+    for i in range(2):
+        dest_image_file = str(
+            os.path.join(fast_tmpdir, "test{}.tiff".format(i))
+        )
+        shutil.copy(image_file, dest_image_file)
+        img_files.append(dest_image_file)
+    # the parent masks first, so it holds a mask pool when it forks
+    main(poni_file, img_files[0], mask_workers=2)
+    assert get_mask_pool(2).submit(sum, (1, 2)).result() == 3
+    out = main(poni_file, img_files, workers=2, mask_workers=2)
+    assert len(out[1]) == 2
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 4])
+def test_prefetch_images(fast_tmpdir, prefetch):
+    imgs = []
+    img_files = []
+    for i in range(6):
+        img = np.random.randint(0, 1000, (32, 32)).astype(np.uint16)
+        fn = str(os.path.join(fast_tmpdir, "test{}.tiff".format(i)))
+        tifffile.imsave(fn, img)
+        imgs.append(img)
+        img_files.append(fn)
+    last = None
+    buffers = set()
+    for (fn, img), fn2, expected in zip(
+        prefetch_images(img_files, read_tiff, prefetch, reuse_buffers=True),
+        img_files,
+        imgs,
+    ):
+        assert fn == fn2
+        # the detector dtype is kept
+        assert img.dtype == np.uint16
+        assert_array_equal(img, expected)
+        # the previous image is not overwritten
+        if last is not None:
+            assert_array_equal(*last)
+        last = (img, expected)
+        buffers.add(id(img))
+    assert len(buffers) == min(prefetch + 2, len(imgs))
+
+
+def test_watch_images(fast_tmpdir):
+    for name in ["test.tiff", "test_zscore.tif", "test.txt"]:
+        with open(os.path.join(str(fast_tmpdir), name), "wb") as f:
+            f.write(b"data")
+    manifest = Manifest(os.path.join(str(fast_tmpdir), "manifest.json"))
+    files = list(
+        watch_images(str(fast_tmpdir), .05, timeout=.2, done=manifest)
+    )
+    assert files == [os.path.join(str(fast_tmpdir), "test.tiff")]
+    # an image without outputs is not done
+    manifest.add(files[0], [])
+    assert files[0] not in manifest
+    output = os.path.join(str(fast_tmpdir), "test.chi")
+    with open(output, "w") as f:
+        f.write("data")
+    manifest.add(files[0], [output])
+    # a restart skips the processed files
+    manifest = Manifest(manifest.filename)
+    assert files[0] in manifest
+    assert not list(
+        watch_images(str(fast_tmpdir), .05, timeout=.2, done=manifest)
+    )
+
+
+def test_main_watch(fast_tmpdir):
+    poni_file = pyfai_poni
+    dest_image_file = str(os.path.join(fast_tmpdir, "test.tiff"))
+    shutil.copy(image_file, dest_image_file)
+    os.chdir(str(fast_tmpdir))
+    kwargs = dict(
+        watch=True,
+        poll_interval=.1,
+        watch_timeout=1,
+        manifest_file="manifest.json",
+    )
+    out = main(poni_file, **kwargs)
+    assert len(out[1]) == 1
+    files = os.listdir(str(fast_tmpdir))
+    for ext in expected_outputs:
+        assert "test" + ext in files
+    # the z score image is not processed and a restart does nothing
+    out = main(poni_file, **kwargs)
+    assert len(out[1]) == 0
+
+
+def test_main_manifest(fast_tmpdir):
+    poni_file = pyfai_poni
+    img_files = []
+    for i in range(2):
+        dest_image_file = str(
+            os.path.join(fast_tmpdir, "test{}.tiff".format(i))
+        )
+        shutil.copy(image_file, dest_image_file)
+        img_files.append(dest_image_file)
+    manifest_file = str(os.path.join(fast_tmpdir, "manifest.json"))
+    out = main(poni_file, img_files, manifest_file=manifest_file)
+    assert len(out[1]) == 2
+    # nothing changed
+    out = main(poni_file, img_files, manifest_file=manifest_file)
+    assert len(out[1]) == 0
+    # a changed image and a missing output
+    img = tifffile.imread(img_files[0])
+    tifffile.imsave(img_files[0], img[::-1])
+    os.remove(str(os.path.join(fast_tmpdir, "test1.chi")))
+    out = main(poni_file, img_files, manifest_file=manifest_file)
+    assert len(out[1]) == 2
+    # new parameters
+    out = main(poni_file, img_files, manifest_file=manifest_file, alpha=4.)
+    assert len(out[1]) == 2
+
+
+def test_main_manifest_written_files(fast_tmpdir):
+    poni_file = pyfai_poni
+    img_files = []
+    for i in range(2):
+        dest_image_file = str(
+            os.path.join(fast_tmpdir, "test{}.tiff".format(i))
+        )
+        shutil.copy(image_file, dest_image_file)
+        img_files.append(dest_image_file)
+    manifest_file = str(os.path.join(fast_tmpdir, "manifest.json"))
+    kwargs = dict(
+        manifest_file=manifest_file,
+        mask_settings="first",
+        outputs="mean,median,std,mask",
+    )
+    out = main(poni_file, img_files, **kwargs)
+    assert len(out[1]) == 2
+    # only the first image gets a mask
+    manifest = Manifest(manifest_file)
+    for fn, exts in zip(
+        img_files,
+        [
+            [".chi", "_median.chi", "_std.chi", ".msk", "_mask.npy"],
+            [".chi", "_median.chi", "_std.chi"],
+        ],
+    ):
+        base = os.path.abspath(os.path.splitext(fn)[0])
+        outputs = manifest.records[os.path.abspath(fn)]["outputs"]
+        assert sorted(outputs) == sorted(base + ext for ext in exts)
+        assert all(os.path.exists(f) for f in outputs)
+    out = main(poni_file, img_files, **kwargs)
+    assert len(out[1]) == 0
+
+
+def test_main_manifest_write_error(fast_tmpdir, monkeypatch):
+    poni_file = pyfai_poni
+    img_files = []
+    for i in range(2):
+        dest_image_file = str(
+            os.path.join(fast_tmpdir, "test{}.tiff".format(i))
+        )
+        shutil.copy(image_file, dest_image_file)
+        img_files.append(dest_image_file)
+    manifest_file = str(os.path.join(fast_tmpdir, "manifest.json"))
+    save_output = process_tiff.save_output
+
+    def fail(tth, intensity, output_name, q_or_2theta):
+        if output_name.endswith("test1_std"):
+            raise OSError("disk full")
+        return save_output(tth, intensity, output_name, q_or_2theta)
+
+    monkeypatch.setattr(process_tiff, "save_output", fail)
+    with pytest.raises(OSError, match="disk full"):
+        main(poni_file, img_files, manifest_file=manifest_file)
+    # the image with the failed write is not done
+    manifest = Manifest(manifest_file)
+    assert os.path.abspath(img_files[0]) in manifest.records
+    assert os.path.abspath(img_files[1]) not in manifest.records
+
+    monkeypatch.setattr(process_tiff, "save_output", save_output)
+    out = main(poni_file, img_files, manifest_file=manifest_file)
+    assert len(out[1]) == 1
+
+
+def test_parse_outputs():
+    assert parse_outputs() == ("mean", "median", "std", "mask", "zscore")
+    assert parse_outputs("mask, mean") == ("mean", "mask")
+    assert parse_outputs(["std"]) == ("std",)
+    with pytest.raises(ValueError):
+        parse_outputs("mean,chi")
+
+
+def test_main_outputs(fast_tmpdir):
+    poni_file = pyfai_poni
+    dest_image_file = str(os.path.join(fast_tmpdir, "test.tiff"))
+    shutil.copy(image_file, dest_image_file)
+    out = main(poni_file, dest_image_file, outputs="mean,mask")
+    assert len(out[1]) == 1
+    # the median and standard deviation are not computed
+    assert len(out[2]) == 0
+    assert len(out[3]) == 0
+    files = os.listdir(str(fast_tmpdir))
+    for ext in [".chi", ".msk", "_mask.npy"]:
+        assert "test" + ext in files
+    for ext in ["_median.chi", "_std.chi", "_zscore.tif"]:
+        assert "test" + ext not in files
+
+
+def test_main_hdf5(fast_tmpdir):
+    poni_file = pyfai_poni
+    img_files = []
+    for i in range(2):
+        dest_image_file = str(
+            os.path.join(fast_tmpdir, "test{}.tiff".format(i))
+        )
+        shutil.copy(image_file, dest_image_file)
+        img_files.append(dest_image_file)
+    hdf5_file = str(os.path.join(fast_tmpdir, "out.h5"))
+    out = main(poni_file, img_files, hdf5_file=hdf5_file)
+    res = read_hdf5(hdf5_file)
+    assert res["mean"]["filename"] == img_files
+    assert_allclose(res["mean"]["data"], out[1])
+    assert_allclose(res["mean"]["q"], out[0])
+    assert_allclose(res["median"]["data"], out[2])
+    assert_allclose(res["std"]["data"], out[3])
+    # the images are the same so the mask is only written once
+    assert res["mask"]["data"].shape == (1, 2048, 2048)
+    assert_array_equal(res["mask"]["index"], [0, 0])
+    assert res["mask"]["filename"] == img_files
+    assert len(res["zscore"]["data"]) == 2
+    # no per image files
+    assert set(os.listdir(str(fast_tmpdir))) == set(
+        ["out.h5", "test0.tiff", "test1.tiff"]
+    )
+
+
+@pytest.mark.parametrize("write_queue", [0, 1, 16])
+def test_main_write_queue(fast_tmpdir, write_queue):
+    poni_file = pyfai_poni
+    img_files = []
+    for i in range(3):
+        dest_image_file = str(
+            os.path.join(fast_tmpdir, "test{}.tiff".format(i))
+        )
+        shutil.copy(image_file, dest_image_file)
+        img_files.append(dest_image_file)
+    main(poni_file, img_files, write_queue=write_queue)
+    # all the writes are done when main returns
+    files = os.listdir(str(fast_tmpdir))
+    for i in range(3):
+        for ext in expected_outputs:
+            assert "test{}".format(i) + ext in files
+    # the images are the same so the masks are too
+    masks = [
+        np.load(str(os.path.join(fast_tmpdir, "test{}_mask.npy".format(i))))
+        for i in range(3)
+    ]
+    assert_equal(masks[0], masks[2])
+
+
+def test_main_manifest_hdf5_flush(fast_tmpdir, monkeypatch):
+    poni_file = pyfai_poni
+    img_files = []
+    for i in range(2):
+        dest_image_file = str(
+            os.path.join(fast_tmpdir, "test{}.tiff".format(i))
+        )
+        shutil.copy(image_file, dest_image_file)
+        img_files.append(dest_image_file)
+    manifest_file = str(os.path.join(fast_tmpdir, "manifest.json"))
+    calls = []
+    flush = HDF5Writer.flush
+    add = Manifest.add
+
+    def flush_spy(self):
+        calls.append("flush")
+        flush(self)
+
+    def add_spy(self, filename, outputs):
+        # the data of the image is on disk before it is recorded
+        assert calls and calls[-1] == "flush"
+        calls.append("add")
+        add(self, filename, outputs)
+
+    monkeypatch.setattr(HDF5Writer, "flush", flush_spy)
+    monkeypatch.setattr(Manifest, "add", add_spy)
+    main(
+        poni_file,
+        img_files,
+        manifest_file=manifest_file,
+        hdf5_file=str(os.path.join(fast_tmpdir, "out.h5")),
+        flush_interval=1e9,
+    )
+    assert calls.count("add") == 2
+    assert len(Manifest(manifest_file).records) == 2
+
+
+def test_main_write_error(fast_tmpdir, monkeypatch):
+    poni_file = pyfai_poni
+    dest_image_file = str(os.path.join(fast_tmpdir, "test.tiff"))
+    shutil.copy(image_file, dest_image_file)
+    closed = []
+    close = HDF5Writer.close
+
+    def fail(self, output, **data):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(HDF5Writer, "append", fail)
+    monkeypatch.setattr(
+        HDF5Writer, "close", lambda self: closed.append(close(self))
+    )
+    with pytest.raises(OSError, match="disk full"):
+        main(
+            poni_file,
+            dest_image_file,
+            hdf5_file=str(os.path.join(fast_tmpdir, "out.h5")),
+        )
+    # the file is closed even though the writes failed
+    assert closed
+
+
+@pytest.mark.parametrize("pack_masks", [True, False])
+def test_main_dedup_masks(fast_tmpdir, pack_masks):
+    poni_file = pyfai_poni
+    img_files = []
+    for i in range(3):
+        dest_image_file = str(
+            os.path.join(fast_tmpdir, "test{}.tiff".format(i))
+        )
+        shutil.copy(image_file, dest_image_file)
+        img_files.append(dest_image_file)
+    main(poni_file, img_files, pack_masks=pack_masks)
+    ext = "_mask.npz" if pack_masks else "_mask.npy"
+    masks = []
+    for i in range(3):
+        for e in [".msk", ext]:
+            fn = str(os.path.join(fast_tmpdir, "test{}{}".format(i, e)))
+            # the same mask is written once and linked
+            assert os.stat(fn).st_nlink == 3
+        masks.append(load_mask(fn))
+    assert masks[0].dtype == bool
+    assert_equal(masks[0], masks[2])
+
+
+def write_stack(fn, imgs):
+    ext = os.path.splitext(fn)[-1]
+    if ext == ".h5":
+        import h5py
+
+        with h5py.File(fn, "w") as f:
+            f.create_dataset("entry/data/data", data=imgs)
+            f.create_dataset(
+                "entry/data/compressed",
+                data=imgs,
+                chunks=(1,) + imgs.shape[1:],
+                compression="gzip",
+            )
+    elif ext == ".edf":
+        from fabio.edfimage import EdfImage
+
+        edf = EdfImage(data=imgs[0])
+        for img in imgs[1:]:
+            edf.append_frame(data=img)
+        edf.write(fn)
+    else:
+        tifffile.imsave(fn, imgs)
+
+
+@pytest.mark.parametrize("ext", [".tiff", ".edf", ".h5"])
+def test_iter_frames(fast_tmpdir, ext):
+    imgs = np.random.randint(0, 1000, (11, 16, 16)).astype(np.uint16)
+    fn = str(os.path.join(fast_tmpdir, "stack" + ext))
+    write_stack(fn, imgs)
+    single = str(os.path.join(fast_tmpdir, "single.tiff"))
+    tifffile.imsave(single, imgs[0])
+    assert isinstance(read_file(fn), FrameStack)
+    frames = list(
+        iter_frames(prefetch_images([single, fn], read_file), batch=4)
+    )
+    assert len(frames) == 12
+    assert frames[0][:2] == (single, single)
+    assert frames[0][3]
+    for i, (f, name, img, last) in enumerate(frames[1:]):
+        assert f == fn
+        assert name == str(
+            os.path.join(fast_tmpdir, "stack_{:02d}{}".format(i, ext))
+        )
+        assert last == (i == 10)
+        assert_array_equal(img, imgs[i])
+
+
+def test_main_multi_frame(fast_tmpdir):
+    poni_file = pyfai_poni
+    dest_image_file = str(os.path.join(fast_tmpdir, "test.tiff"))
+    shutil.copy(image_file, dest_image_file)
+    img = tifffile.imread(image_file)
+    stack_file = str(os.path.join(fast_tmpdir, "stack.tiff"))
+    tifffile.imsave(stack_file, np.stack([img] * 3))
+    single = main(poni_file, dest_image_file)
+    manifest_file = str(os.path.join(fast_tmpdir, "manifest.json"))
+    out = main(poni_file, stack_file, manifest_file=manifest_file)
+    assert len(out[1]) == 3
+    for x in out[1]:
+        assert_allclose(x, single[1][0])
+    files = os.listdir(str(fast_tmpdir))
+    for i in range(3):
+        for ext in expected_outputs:
+            assert "stack_{}".format(i) + ext in files
+    # the stack is recorded once, with the outputs of all its frames
+    records = Manifest(manifest_file).records
+    assert list(records) == [os.path.abspath(stack_file)]
+    assert len(records[os.path.abspath(stack_file)]["outputs"]) == 3 * 6
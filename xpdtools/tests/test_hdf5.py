@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from xpdtools.hdf5 import HDF5Writer, read_hdf5
+
+
+def test_hdf5_writer(fast_tmpdir):
+    fn = os.path.join(fast_tmpdir, "test.h5")
+    means = [np.random.random(10) for _ in range(3)]
+    masks = [np.random.random((8, 8)) > .5 for _ in range(3)]
+    zscores = [np.random.random((8, 8)).astype(np.float32) for _ in range(3)]
+    with HDF5Writer(fn, flush_interval=0) as writer:
+        for i, (m, msk, z) in enumerate(zip(means, masks, zscores)):
+            name = "test{}.tiff".format(i)
+            writer.append("mean", data=m, q=np.arange(10), filename=name)
+            writer.append("mask", data=msk, filename=name)
+            writer.append("zscore", data=z, filename=name)
+        # a row can be read before the file is closed
+        assert_array_equal(read_hdf5(fn, "mean")["data"], means)
+        ds = writer.file["mean/data"]
+        assert ds.compression == "gzip"
+        assert ds.chunks == (64, 10)
+        assert writer.file["zscore/data"].compression is None
+    out = read_hdf5(fn)
+    assert out["mean"]["filename"] == [
+        "test0.tiff",
+        "test1.tiff",
+        "test2.tiff",
+    ]
+    assert_array_equal(out["mean"]["q"], [np.arange(10)] * 3)
+    assert_array_equal(out["mask"]["data"], masks)
+    assert out["mask"]["data"].dtype == bool
+    assert_array_equal(out["zscore"]["data"], zscores)
+    # an existing file is appended to
+    with HDF5Writer(fn) as writer:
+        writer.append("mean", data=means[0], q=np.arange(10), filename="a")
+    assert len(read_hdf5(fn, "mean")["data"]) == 4
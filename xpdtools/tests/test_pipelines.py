@@ -16,13 +16,19 @@ from xpdtools.pipelines.raw_pipeline import (
     namespace as g_namespace,
 )
 from rapidz.link import link
-from xpdtools.pipelines.extra import z_score_gen, median_gen, std_gen
+from xpdtools.pipelines.extra import (
+    z_score_gen,
+    median_gen,
+    std_gen,
+    stats_gen,
+)
 from xpdtools.pipelines.tomo import (
     tomo_prep,
     tomo_pipeline_piecewise,
     tomo_pipeline_theta,
 )
 from rapidz import destroy_pipeline, Stream
+from xpdtools.tools import generate_polarization, z_score_image
 from numpy.testing import assert_allclose
 
 img = tifffile.imread(image_file)
@@ -67,6 +73,27 @@ def test_raw_pipeline(mask_s):
     ml.clear()
 
 
+def test_raw_pipeline_correction():
+    namespace = link(*pipeline_order, **dict(g_namespace, bg_scale=2.))
+    corrected = namespace["pol_corrected_img"].sink_to_list()
+    bg_corrected = namespace["bg_corrected_img"].sink_to_list()
+    rs = np.random.RandomState(42)
+    fg_dark, bg, bg_dark = (rs.uniform(0, 10, img.shape) for _ in range(3))
+    namespace["geometry"].emit(geo)
+    namespace["raw_background_dark"].emit(bg_dark)
+    namespace["raw_background"].emit(bg)
+    namespace["raw_foreground_dark"].emit(fg_dark)
+    namespace["raw_foreground"].emit(img)
+    destroy_pipeline(namespace["raw_foreground"])
+    assert len(corrected) == 1
+    assert len(bg_corrected) == 1
+    # the single pass agrees with the chain of subtractions and division
+    expected = (img - fg_dark) - (bg - bg_dark) * 2.
+    assert_allclose(bg_corrected[0], expected)
+    pol = generate_polarization(geo, img.shape, .99)
+    assert_allclose(corrected[0], expected / pol, rtol=1e-6)
+
+
 def test_extra_pipeline():
     # link the pipeline up
     namespace = link(
@@ -92,6 +119,51 @@ def test_extra_pipeline():
     sl.clear()
 
 
+def run_extra(chunks, **kwargs):
+    namespace = link(*(pipeline_order + chunks), **g_namespace, **kwargs)
+    names = ["median", "std", "percentile", "z_score"]
+    lists = {k: namespace[k].sink_to_list() for k in names if k in namespace}
+    namespace["geometry"].emit(geo)
+    for s in ["raw_background_dark", "raw_background", "raw_foreground_dark"]:
+        namespace[s].emit(np.zeros(img.shape))
+    namespace["raw_foreground"].emit(img)
+    destroy_pipeline(namespace["raw_foreground"])
+    return lists
+
+
+def test_stats_pipeline():
+    old = run_extra([median_gen, std_gen])
+    new = run_extra([stats_gen, z_score_gen], percentiles=[50])
+    for k in ["median", "std", "percentile", "z_score"]:
+        assert len(new[k]) == 1
+    # one pass over the image gives the same statistics
+    assert_allclose(new["median"][0], old["median"][0])
+    assert_allclose(new["std"][0], old["std"][0])
+    assert_allclose(np.nan_to_num(new["percentile"][0][0]), new["median"][0])
+
+
+@pytest.mark.parametrize(
+    "chunks", [[stats_gen, z_score_gen], [z_score_gen, stats_gen]]
+)
+def test_z_score_pipeline_order(chunks):
+    namespace = link(*(pipeline_order + chunks), **g_namespace)
+    z_score = namespace["z_score"].sink_to_list()
+    binner = namespace["binner"].sink_to_list()
+    namespace["geometry"].emit(geo)
+    for s in ["raw_background_dark", "raw_background", "raw_foreground_dark"]:
+        namespace[s].emit(np.zeros(img.shape))
+    imgs = [img, img[::-1, ::-1]]
+    for i in imgs:
+        namespace["raw_foreground"].emit(i)
+    destroy_pipeline(namespace["raw_foreground"])
+    assert len(z_score) == 2
+    # each z score uses the statistics of its own image
+    pol = generate_polarization(geo, img.shape, .99)
+    for z, i, b in zip(z_score, imgs, binner):
+        expected = z_score_image(i / pol, b)
+        assert_allclose(np.ravel(z)[b.xy > 0], np.ravel(expected)[b.xy > 0])
+
+
 def test_qoi_pipeline():
     # link the pipeline up
     namespace = link(
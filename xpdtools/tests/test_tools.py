@@ -12,11 +12,19 @@
 # See LICENSE.txt for license information.
 #
 ##############################################################################
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import pytest
 
 import numpy as np
-from numpy.testing import assert_equal
+from numpy.testing import assert_equal, assert_allclose
+from scipy.integrate import simps
 
+from xpdtools import cache, tools
+from xpdtools.binning import RingIndex
+from xpdtools.shim import PDFGetterShim
 from xpdtools.tests.utils import pyFAI_calib
 from xpdtools.tools import (
     load_geo,
@@ -29,8 +37,21 @@ from xpdtools.tools import (
     generate_map_bin,
     generate_binner,
     move_center,
+    get_mask_pool,
+    binned_statistics,
+    correct_image,
+    sq_fq_pdf_getter,
+    nu_pdf_getter,
+    batch_pdf_getter,
+    cached_sq_fq_pdf_getter,
+    save_mask,
+    load_mask,
+)
+from xpdtools.jit_tools import (
+    mask_ring_median,
+    mask_ring_mean,
+    mask_ring_median_segmented,
 )
-from xpdtools.jit_tools import mask_ring_median, mask_ring_mean
 
 geo = load_geo(pyFAI_calib)
 
@@ -41,12 +62,67 @@ def test_mask_ring_mean():
     assert mask_ring_mean(values, positions, 1) == np.argmax(values)
 
 
+def legacy_mask_ring_mean(values_array, positions_array, alpha):
+    m = np.ones(positions_array.shape, dtype=bool)
+    removals = []
+    while True:
+        m[np.isin(positions_array, removals)] = False
+        v = values_array[m]
+        if len(v) <= 1:
+            break
+        std = np.std(v)
+        if std == 0.0:
+            break
+        norm_v_list = np.abs(v - np.mean(v)) / std
+        if np.all(norm_v_list < alpha):
+            break
+        removals.append(positions_array[m][np.argmax(norm_v_list)])
+    return removals
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_mask_ring_mean_legacy(seed):
+    r = np.random.RandomState(seed)
+    values = np.concatenate(
+        (r.normal(10, 1, 200), r.randint(0, 4, 100).astype(float))
+    )
+    values[r.randint(0, len(values), 10)] = 50
+    values[r.randint(0, len(values), 5)] = -50
+    positions = r.permutation(len(values))
+    assert_equal(
+        np.sort(mask_ring_mean(values, positions, 2.5)),
+        np.sort(legacy_mask_ring_mean(values, positions, 2.5)),
+    )
+
+
 def test_mask_ring_median():
     values = np.asarray([0, 0, 0, 1, 0, 0, 0, 0])
     positions = np.arange(0, len(values))
     assert mask_ring_median(values, positions, 3) == np.argmax(values)
 
 
+def test_mask_ring_median_segmented():
+    r = np.random.RandomState(42)
+    counts = np.asarray([0, 8, 3, 0, 20, 1])
+    values = r.random_sample(np.sum(counts))
+    values[[3, 15]] = 100
+    mask = r.randint(0, 5, len(values)).astype(bool)
+    positions = np.arange(len(values))
+    removals = mask_ring_median_segmented(values, mask, counts, 1.5)
+    expected = []
+    i = 0
+    for k in counts:
+        m = mask[i : i + k]
+        if k > 0 and np.any(m):
+            expected.extend(
+                mask_ring_median(
+                    values[i : i + k][m], positions[i : i + k][m], 1.5
+                )
+            )
+        i += k
+    assert_equal(positions[removals], np.sort(expected))
+
+
 def test_load_geo():
     geo = load_geo(pyFAI_calib)
     assert geo
@@ -68,7 +144,9 @@ def test_generate_binner_mask():
     assert b
 
 
-@pytest.mark.parametrize("mask_method", ["mean", "median"])
+@pytest.mark.parametrize(
+    "mask_method", ["mean", "median", "segmented_median"]
+)
 def test_binned_outlier(mask_method):
     b = map_to_binner(*generate_map_bin(geo, (2048, 2048)))
     img = np.ones((2048, 2048))
@@ -80,6 +158,48 @@ def test_binned_outlier(mask_method):
     assert_equal(np.where(mask.ravel() == 0)[0], bad)
 
 
+def test_segmented_median_matches_median():
+    b = map_to_binner(*generate_map_bin(geo, (2048, 2048)))
+    r = np.random.RandomState(42)
+    img = r.normal(100, 10, (2048, 2048))
+    tmsk = r.randint(0, 10, (2048, 2048)).astype(bool)
+    a = binned_outlier(img, b, tmsk=tmsk, mask_method="median")
+    c = binned_outlier(img, b, tmsk=tmsk, mask_method="segmented_median")
+    assert_equal(a, c)
+
+
+def test_binned_outlier_pool():
+    b = map_to_binner(*generate_map_bin(geo, (2048, 2048)))
+    img = np.ones((2048, 2048))
+    pool = ThreadPoolExecutor(max_workers=2)
+    binned_outlier(img, b, pool=pool)
+    # the pool is still usable after masking
+    assert pool.submit(sum, (1, 2)).result() == 3
+    pool.shutdown()
+
+
+def test_get_mask_pool():
+    assert get_mask_pool() is get_mask_pool()
+    assert get_mask_pool(2) is get_mask_pool(2)
+    assert get_mask_pool(2) is not get_mask_pool(3)
+
+
+def _mask_in_child():
+    return get_mask_pool(2).submit(sum, (1, 2)).result(timeout=30)
+
+
+@pytest.mark.skipif(
+    not hasattr(os, "register_at_fork"), reason="needs os.register_at_fork"
+)
+def test_get_mask_pool_fork():
+    # the pool is created in the parent, a forked child doesn't get its
+    # threads
+    assert get_mask_pool(2).submit(sum, (1, 2)).result() == 3
+    ctx = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        assert pool.submit(_mask_in_child).result(timeout=60) == 3
+
+
 def test_z_score_image():
     b = map_to_binner(*generate_map_bin(geo, (2048, 2048)))
     img = np.ones((2048, 2048))
@@ -91,6 +211,87 @@ def test_z_score_image():
     assert all(z_score[urbad] > 2)
 
 
+@pytest.mark.parametrize("offset, scale", [(0, 1), (1e4, 1), (1e6, .01)])
+def test_z_score_image_stats(offset, scale):
+    shape = (2048, 2048)
+    r = np.random.RandomState(42)
+    mask = r.random_sample(shape) > .1
+    b = map_to_binner(*generate_map_bin(geo, shape), mask=mask)
+    img = offset + r.random_sample(shape) * scale
+    # the per ring z score
+    vfs = img.ravel()[b.argsort_index]
+    expected = np.empty(vfs.shape)
+    i = 0
+    for k in b.flatcount:
+        if k > 0:
+            ring = vfs[i : i + k]
+            with np.errstate(all="ignore"):
+                expected[b.argsort_index[i : i + k]] = (
+                    ring - ring.mean()
+                ) / ring.std()
+        i += k
+    expected = np.nan_to_num(expected).reshape(shape)
+
+    # z scores close to zero only agree to an absolute tolerance
+    assert_allclose(z_score_image(img, b), expected, atol=1e-6)
+    stats = binned_statistics(img, b)
+    assert_allclose(z_score_image(img, b, stats), expected, atol=1e-6)
+    out = np.empty(shape, dtype=np.float32)
+    z_score = z_score_image(img, b, stats, out=out)
+    assert z_score is out
+    assert_allclose(z_score, expected, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("ring_index", [False, True])
+def test_binned_statistics(ring_index):
+    shape = (2048, 2048)
+    r = np.random.RandomState(42)
+    mask = r.random_sample(shape) > .1
+    b = map_to_binner(*generate_map_bin(geo, shape), mask=mask)
+    img = r.random_sample(shape)
+    binner = RingIndex.from_binner(b) if ring_index else b
+    stats = binned_statistics(img, binner, percentiles=[10, 50, 90])
+    for statistic in ["mean", "median", "std", "count"]:
+        assert_allclose(stats[statistic], b(img.ravel(), statistic))
+    assert stats["percentiles"].shape == (3, len(b.bin_centers))
+    assert_allclose(stats["percentiles"][1], stats["median"])
+    # every ring, the empty ones are NaN
+    vfs = img.ravel()[b.argsort_index]
+    offsets = np.cumsum(b.flatcount)
+    for j in range(len(b.bin_centers)):
+        ring = vfs[offsets[j] : offsets[min(j + 1, len(offsets) - 1)]]
+        if len(ring):
+            expected = np.percentile(ring, [10, 50, 90])
+        else:
+            expected = np.full(3, np.nan)
+        assert_allclose(stats["percentiles"][:, j], expected)
+
+
+@pytest.mark.parametrize("pack", [True, False])
+def test_save_load_mask(fast_tmpdir, pack):
+    mask = np.random.random((37, 41)) > .5
+    fn = os.path.join(fast_tmpdir, "mask.npz" if pack else "mask.npy")
+    save_mask(fn, mask, pack)
+    loaded = load_mask(fn)
+    assert loaded.dtype == bool
+    assert_equal(loaded, mask)
+
+
+def test_correct_image():
+    shape = (2048, 2048)
+    fg = np.random.randint(0, 2 ** 16, shape).astype(np.uint16)
+    fg_dark, bg, bg_dark = np.random.random((3,) + shape) * 100
+    pol = geo.polarization(shape, .99)
+    expected = ((fg - fg_dark) - (bg - bg_dark) * .5) / pol
+    assert_equal(correct_image(fg, fg_dark, bg, bg_dark, .5, pol), expected)
+    assert_equal(correct_image(fg, bg=bg), fg - bg)
+    assert_equal(correct_image(fg, 0., bg, 0.), fg - bg)
+    out = np.empty(shape, dtype=np.float32)
+    img = correct_image(fg, fg_dark, bg, bg_dark, .5, pol, out=out)
+    assert img is out
+    assert_allclose(img, expected, rtol=1e-6)
+
+
 def test_polarization_correction():
     img = np.ones((2048, 2048))
     pimg = polarization_correction(img, geo, .99)
@@ -106,7 +307,9 @@ def test_overlay_mask():
     assert_equal(img2, img)
 
 
-@pytest.mark.parametrize("mask_method", ["mean", "median"])
+@pytest.mark.parametrize(
+    "mask_method", ["mean", "median", "segmented_median"]
+)
 def test_mask_img(mask_method):
     b = map_to_binner(*generate_map_bin(geo, (2048, 2048)))
     img = np.ones((2048, 2048))
@@ -132,3 +335,109 @@ def test_move_center():
     nn = ("poni1", "poni2")
     for mm, n in zip(m, nn):
         assert getattr(g2, n) == getattr(geo, n) + mm
+
+
+@pytest.mark.parametrize(
+    "fq_qmax, pdf_qmax, runs", [(22, 22, 1), (20, 22, 1), (25, 22, 2)]
+)
+def test_sq_fq_pdf_getter(monkeypatch, fq_qmax, pdf_qmax, runs):
+    calls = []
+
+    class PDFGetter(PDFGetterShim):
+        def __call__(self, x, y, **kwargs):
+            calls.append(kwargs)
+            self.config = dict(kwargs)
+            keep = x <= kwargs["qmax"]
+            self.sq = x[keep], y[keep] * 2
+            self.fq = x[keep], y[keep] * 3
+            return x, y
+
+    monkeypatch.setattr(tools, "PDFGetter", PDFGetter)
+    q = np.linspace(0, 30, 301)
+    iq = np.random.random(q.shape)
+    sq, fq, pdf = sq_fq_pdf_getter(
+        q,
+        iq,
+        "Ni",
+        fq_kwargs=dict(dataformat="QA", qmax=fq_qmax),
+        pdf_kwargs=dict(dataformat="QA", qmax=pdf_qmax),
+    )
+    assert len(calls) == runs
+    assert pdf[2]["qmax"] == pdf_qmax
+    for res, scale in [(sq, 2), (fq, 3)]:
+        assert res[2]["qmax"] == fq_qmax
+        assert_equal(res[0], q[q <= fq_qmax])
+        assert_equal(res[1], iq[q <= fq_qmax] * scale)
+
+
+@pytest.mark.parametrize("max_bytes", [None, 100000])
+def test_nu_pdf_getter(max_bytes):
+    q = np.sort(np.random.random(3001)) * 25 + .5
+    fq = np.random.random((3, len(q)))
+    rgrid = np.arange(0, 30.01, np.pi / np.max(q))
+    r, gr = nu_pdf_getter(q, fq[0], max_bytes=max_bytes)
+    assert_equal(r, rgrid)
+    expected = simps(2 / np.pi * fq[0] * np.sin(q * rgrid[:, np.newaxis]), q)
+    assert_allclose(gr, expected)
+    # a stack of patterns on the same grid
+    r, grs = nu_pdf_getter(q, fq, max_bytes=max_bytes)
+    assert grs.shape == (3, len(rgrid))
+    assert_allclose(grs[0], expected)
+
+
+class LinearPDFGetter(PDFGetterShim):
+    """PDFGetter stand in whose results are linear in the intensity"""
+
+    def __init__(self):
+        super().__init__()
+        self.transformations = list(range(8))
+        self.kwargs = {}
+
+    def __call__(self, x, y, **kwargs):
+        self.kwargs.update(kwargs)
+        self.config = dict(self.kwargs)
+        self.sq = x, y + 1
+        self.fq = x, y * 2
+        return x[::2], y[::2] * 3
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_batch_pdf_getter(monkeypatch, max_workers):
+    monkeypatch.setattr(tools, "PDFGetter", LinearPDFGetter)
+    q = np.linspace(.5, 25, 200)
+    iqs = np.random.random((7, len(q)))
+    r, gr, fq_q, fq, config = batch_pdf_getter(
+        q, iqs, "Ni", max_workers=max_workers, qmax=20
+    )
+    assert_equal(r, q[::2])
+    assert_equal(gr, iqs[:, ::2] * 3)
+    assert_equal(fq_q, q)
+    assert_equal(fq, iqs * 2)
+    assert config == dict(qmax=20, composition="Ni")
+
+
+def test_batch_pdf_getter_non_uniform(monkeypatch):
+    monkeypatch.setattr(tools, "PDFGetter", LinearPDFGetter)
+    q = np.sort(np.random.random(300)) * 25
+    iqs = np.random.random((3, len(q)))
+    r, gr, fq_q, fq, config = batch_pdf_getter(
+        q, iqs, "Ni", non_uniform=True, max_workers=1, qmin=1, qmaxinst=20
+    )
+    keep = (q > 1) & (q < 20)
+    assert_equal(fq_q, q[keep])
+    assert_equal(fq, iqs[:, keep] * 2)
+    for g, f in zip(gr, fq):
+        assert_allclose(g, nu_pdf_getter(fq_q, f)[1])
+
+
+def test_cached_sq_fq_pdf_getter(monkeypatch):
+    monkeypatch.setattr(tools, "PDFGetter", LinearPDFGetter)
+    monkeypatch.setattr(cache, "pdf_cache", cache.ResultCache())
+    q = np.linspace(.5, 25, 200)
+    iq = np.random.random(q.shape)
+    kwargs = dict(pdf_kwargs=dict(qmax=20))
+    a = cached_sq_fq_pdf_getter(q, iq, "Ni", **kwargs)
+    assert cached_sq_fq_pdf_getter(q, iq.copy(), "Ni", **kwargs) is a
+    assert cached_sq_fq_pdf_getter(q, iq, "Fe", **kwargs) is not a
+    assert cache.pdf_cache.hit_rate == 1 / 3
+    assert_equal(a[2][1], iq[::2] * 3)
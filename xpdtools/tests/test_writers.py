@@ -0,0 +1,43 @@
+import time
+
+import pytest
+
+from xpdtools.writers import AsyncWriter
+
+
+def test_async_writer():
+    out = []
+
+    def write(x, delay=0):
+        time.sleep(delay)
+        out.append(x)
+
+    writer = AsyncWriter(maxsize=2)
+    queued_write = writer.wrap(write)
+    for i in range(5):
+        queued_write(i, delay=.01)
+    stats = writer.close()
+    # the writes are done, in order
+    assert out == list(range(5))
+    assert stats["written"] == 5
+    assert stats["depth"] == 0
+    assert 1 <= stats["max_depth"] <= 2
+    assert stats["max_latency"] >= .01
+    with pytest.raises(RuntimeError):
+        writer.submit(write, 5)
+
+
+def test_async_writer_error():
+    out = []
+
+    def write(x):
+        if x == 1:
+            raise ValueError(x)
+        out.append(x)
+
+    writer = AsyncWriter()
+    for i in range(3):
+        writer.submit(write, i)
+    with pytest.raises(ValueError):
+        writer.close()
+    assert out == [0, 2]
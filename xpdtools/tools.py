@@ -16,14 +16,33 @@
 from sklearn.decomposition import PCA
 
 import copy
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from functools import wraps
+from itertools import repeat
 
 import numpy as np
 from scipy.integrate import simps
 from skbeam.core.accumulators.binned_statistic import BinnedStatistic1D
 from skbeam.core.mask import margin
-from xpdtools.jit_tools import mask_ring_median, mask_ring_mean, ring_zscore
+from skbeam.io.fit2d import read_fit2d_msk
+from xpdtools import cache
+from xpdtools.binning import PrecomputedBinner, _compact_index
+from xpdtools.jit_tools import (
+    mask_ring_median,
+    mask_ring_mean,
+    mask_ring_median_segmented,
+    ring_stats,
+    bin_moments,
+    bin_zscore,
+    correct_pixels,
+)
 
 try:
     from diffpy.pdfgetx import PDFGetter
@@ -31,6 +50,50 @@ except ImportError:
     from xpdtools.shim import PDFGetterShim as PDFGetter
 
 mask_ring_dict = {"median": mask_ring_median, "mean": mask_ring_mean}
+# maskers which process all the rings in one compiled call
+mask_segment_dict = {"segmented_median": mask_ring_median_segmented}
+
+_mask_pools = {}
+_mask_pools_lock = threading.Lock()
+
+
+def _reset_mask_pools():
+    """Forget the pools in a forked child, their threads are not forked"""
+    global _mask_pools, _mask_pools_lock
+    _mask_pools = {}
+    _mask_pools_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_mask_pools)
+
+
+def get_mask_pool(max_workers=None):
+    """Get the process wide thread pool used for masking
+
+    The pool is created on first use and reused by every later call asking
+    for the same number of workers, so masking doesn't pay for thread
+    start-up on every frame.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        The number of worker threads. If None use the number of CPUs.
+        Defaults to None.
+
+    Returns
+    -------
+    ThreadPoolExecutor :
+        The shared pool
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    with _mask_pools_lock:
+        if max_workers not in _mask_pools:
+            _mask_pools[max_workers] = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="xpdtools_mask"
+            )
+        return _mask_pools[max_workers]
 
 
 def progress_decorator(func, progress=None):
@@ -47,7 +110,13 @@ def progress_decorator(func, progress=None):
 
 
 def binned_outlier(
-    img, binner, alpha=3, tmsk=None, mask_method="median", pool=None
+    img,
+    binner,
+    alpha=3,
+    tmsk=None,
+    mask_method="median",
+    pool=None,
+    max_workers=None,
 ):
     """Sigma Clipping based masking
 
@@ -55,17 +124,24 @@ def binned_outlier(
     ----------
     img : np.ndarray
         The image
-    binner : BinnedStatistic1D instance
+    binner : BinnedStatistic1D or RingIndex instance
         The binned statistics information
     alpha : float, optional
         The number of standard deviations to clip, defaults to 3
     tmsk : np.ndarray, optional
         Prior mask. If None don't use a prior mask, defaults to None.
-    mask_method : {'median', 'mean'}, optional
+    mask_method : {'median', 'mean', 'segmented_median'}, optional
         The method to use for creating the mask, median is faster, mean is more
-        accurate. Defaults to median.
-    pool : Executor instance
-        A pool against which jobs can be submitted for parallel processing
+        accurate. 'segmented_median' produces the same mask as 'median' but
+        processes all the rings in a single compiled pass without the pool.
+        Defaults to median.
+    pool : Executor instance, optional
+        A pool against which jobs can be submitted for parallel processing.
+        The pool is not shut down after use. If None use the shared pool from
+        ``get_mask_pool``. Defaults to None.
+    max_workers : int, optional
+        The number of workers of the shared pool, only used if ``pool`` is
+        None. If None use the number of CPUs. Defaults to None.
 
     Returns
     -------
@@ -73,8 +149,6 @@ def binned_outlier(
         The mask
     """
     print("start auto mask")
-    if pool is None:
-        pool = ThreadPoolExecutor(max_workers=20)
     # skbeam 0.0.12 doesn't have argsort_index cached
     try:
         idx = binner.argsort_index
@@ -84,33 +158,32 @@ def binned_outlier(
         tmsk = np.ones(np.shape(img), dtype=np.bool)
     tmsk = tmsk.flatten()
     tmsk2 = tmsk[idx]
-    vfs = img.flatten()[idx]
-    pfs = np.arange(np.size(img))[idx]
-    t = []
-    i = 0
-    for k in binner.flatcount:
-        m = tmsk2[i : i + k]
-        vm = vfs[i : i + k][m]
-        if k > 0 and len(vm) > 0:
-            t.append((vm, (pfs[i : i + k][m]), alpha))
-        i += k
+    vfs = np.ravel(img)[idx]
+    # the sort permutation holds the flattened position of each value
+    pfs = idx
     p_err = np.seterr(all="ignore")
-    # only run tqdm on mean since it is slow
-    if mask_method == "mean":
-        import tqdm
-
-        progress = tqdm.tqdm(total=len(t))
-        pu = progress.update
-    else:
-        pu = None
-    with pool as p:
-        futures = [
-            p.submit(progress_decorator(mask_ring_dict[mask_method], pu), *x)
-            for x in t
+    if mask_method in mask_segment_dict:
+        # all the rings are handled in one call, so no per ring slices
+        removals = pfs[
+            mask_segment_dict[mask_method](
+                vfs, tmsk2, binner.flatcount, alpha
+            )
         ]
-    removals = []
-    for f in as_completed(futures):
-        removals.extend(f.result())
+    else:
+        if pool is None:
+            pool = get_mask_pool(max_workers)
+        t = []
+        i = 0
+        for k in binner.flatcount:
+            m = tmsk2[i : i + k]
+            vm = vfs[i : i + k][m]
+            if k > 0 and len(vm) > 0:
+                t.append((vm, (pfs[i : i + k][m]), alpha))
+            i += k
+        futures = [pool.submit(mask_ring_dict[mask_method], *x) for x in t]
+        removals = []
+        for f in as_completed(futures):
+            removals.extend(f.result())
     np.seterr(**p_err)
     tmsk[removals] = False
     tmsk = tmsk.reshape(np.shape(img))
@@ -128,6 +201,7 @@ def mask_img(
     auto_type="median",
     tmsk=None,
     pool=None,
+    max_workers=None,
 ):
     """
     Mask an image based off of various methods
@@ -136,7 +210,7 @@ def mask_img(
     ----------
     img: np.ndarray
         The image to be masked
-    binner : BinnedStatistic1D instance
+    binner : BinnedStatistic1D or RingIndex instance
         The binned statistics information
     edge: int, optional
         The number of edge pixels to mask. Defaults to 30. If None, no edge
@@ -153,14 +227,19 @@ def mask_img(
         a linear distribution of alphas from alpha[0] to alpha[1], if array
         then we just use that as the distribution of alphas. Defaults to 3.
         If None, no outlier masking applied.
-    auto_type: {'median', 'mean'}, optional
+    auto_type: {'median', 'mean', 'segmented_median'}, optional
         The type of binned outlier masking to be done, 'median' is faster,
-        where 'mean' is more accurate, defaults to 'median'.
+        where 'mean' is more accurate, 'segmented_median' gives the same
+        result as 'median' in a single compiled pass, defaults to 'median'.
     tmsk: np.ndarray, optional
         The starting mask to be compounded on. Defaults to None. If None mask
         generated from scratch.
-    pool : Executor instance
-        A pool against which jobs can be submitted for parallel processing
+    pool : Executor instance, optional
+        A pool against which jobs can be submitted for parallel processing.
+        If None use the shared pool from ``get_mask_pool``. Defaults to None.
+    max_workers : int, optional
+        The number of workers of the shared pool, only used if ``pool`` is
+        None. If None use the number of CPUs. Defaults to None.
 
     Returns
     -------
@@ -188,12 +267,21 @@ def mask_img(
             tmsk=working_mask,
             mask_method=auto_type,
             pool=pool,
+            max_workers=max_workers,
         )
     working_mask = working_mask.astype(np.bool)
     return working_mask
 
 
-def generate_map_bin(geo, img_shape):
+def _geometry_disk_cache(use):
+    """The disk cache for geometry derived arrays, a disabled one if not
+    ``use``"""
+    if use:
+        return cache.geometry_cache
+    return cache.DiskCache("")
+
+
+def generate_map_bin(geo, img_shape, disk_cache=True):
     """Create a q map and the pixel resolution bins
 
     Parameters
@@ -202,6 +290,10 @@ def generate_map_bin(geo, img_shape):
         The calibrated geometry
     img_shape : tuple, optional
         The shape of the image, if None pull from the mask. Defaults to None.
+    disk_cache : bool, optional
+        If False the results are not loaded from or stored in
+        ``xpdtools.cache.geometry_cache``, eg for geometries which are only
+        used once. Defaults to True.
 
     Returns
     -------
@@ -209,10 +301,32 @@ def generate_map_bin(geo, img_shape):
         The q map
     qbin : ndarray
         The pixel resolution bins
+
+    Notes
+    -----
+    The (read only) results are kept in ``xpdtools.cache.memory_cache`` and
+    stored in ``xpdtools.cache.geometry_cache`` so they are loaded back
+    (memory mapped) for the same geometry and shape.
     """
-    r = geo.rArray(img_shape)
-    q = geo.qArray(img_shape) / 10  # type: np.ndarray
-    q_dq = geo.deltaQ(img_shape) / 10  # type: np.ndarray
+    key = cache.geometry_fingerprint(geo, img_shape)
+    return cache.memory_cache.cached_call(
+        ("map_bin", key),
+        _generate_map_bin,
+        geo,
+        img_shape,
+        key,
+        _geometry_disk_cache(disk_cache),
+    )
+
+
+def _generate_map_bin(geo, img_shape, key, disk):
+    cached = disk.get(key, ("q", "qbin"))
+    if cached is not None:
+        return cached["q"], cached["qbin"]
+    with _release_arrays(geo):
+        r = geo.rArray(img_shape)
+        q = geo.qArray(img_shape) / 10  # type: np.ndarray
+        q_dq = geo.deltaQ(img_shape) / 10  # type: np.ndarray
 
     pixel_size = [getattr(geo, a) for a in ["pixel1", "pixel2"]]
     rres = np.hypot(*pixel_size)
@@ -225,7 +339,8 @@ def generate_map_bin(geo, img_shape):
     qbin[0] = np.min(q_dq)
     if np.max(q) > qbin[-1]:
         qbin[-1] = np.max(q)
-    return q, qbin
+    disk.put(key, q=q, qbin=qbin)
+    return _read_only(q), _read_only(qbin)
 
 
 def map_to_binner(pixel_map, bins, mask=None):
@@ -251,7 +366,29 @@ def map_to_binner(pixel_map, bins, mask=None):
     return BinnedStatistic1D(pixel_map.flatten(), bins=bins, mask=mask)
 
 
-def generate_binner(geo, img_shape, mask=None):
+def mask_binner(binner, mask=None):
+    """Apply a mask to a binner without binning the pixels again
+
+    Parameters
+    ----------
+    binner : BinnedStatistic1D instance
+        The unmasked binner, eg. from ``generate_binner``
+    mask : np.ndarray, optional
+        The mask, True pixels are good pixels. If None no mask is applied.
+        Defaults to None.
+
+    Returns
+    -------
+    PrecomputedBinner :
+        The masked binner
+    """
+    binner = PrecomputedBinner.from_binner(binner)
+    if mask is None:
+        return binner
+    return binner.with_mask(mask)
+
+
+def generate_binner(geo, img_shape, mask=None, disk_cache=True):
     """Create a pixel resolution BinnedStats1D instance
 
     Parameters
@@ -262,52 +399,360 @@ def generate_binner(geo, img_shape, mask=None):
         The shape of the image, if None pull from the mask. Defaults to None.
     mask : np.ndarray, optional
         The mask to be applied, if None no mask is applied. Defaults to None.
+    disk_cache : bool, optional
+        If False the results are not loaded from or stored in
+        ``xpdtools.cache.geometry_cache``, eg for geometries which are only
+        used once. Defaults to True.
     Returns
     -------
     BinnedStatistic1D :
         The configured instance of the binner.
+
+    Notes
+    -----
+    Unmasked binners are kept in ``xpdtools.cache.memory_cache`` and their
+    bin assignment and sort order are stored in
+    ``xpdtools.cache.geometry_cache`` so the binner can be rebuilt without
+    digitizing or sorting the pixels.
+    """
+    if mask is not None:
+        return map_to_binner(
+            *generate_map_bin(geo, img_shape, disk_cache), mask=mask
+        )
+    key = cache.geometry_fingerprint(geo, img_shape)
+    return cache.memory_cache.cached_call(
+        ("binner", key),
+        _generate_binner,
+        geo,
+        img_shape,
+        key,
+        disk_cache,
+    )
+
+
+def _generate_binner(geo, img_shape, key, disk_cache):
+    disk = _geometry_disk_cache(disk_cache)
+    cached = disk.get(key, ("qbin", "xy", "argsort_index"))
+    if cached is not None:
+        return PrecomputedBinner(
+            cached["xy"], cached["qbin"], argsort_index=cached["argsort_index"]
+        )
+    binner = map_to_binner(*generate_map_bin(geo, img_shape, disk_cache))
+    size = len(binner.xy)
+    disk.put(
+        key,
+        xy=_compact_index(binner.xy, size),
+        argsort_index=_compact_index(binner.argsort_index, size),
+    )
+    return binner
+
+
+def generate_polarization(
+    geo, img_shape, polarization_factor=.99, disk_cache=True
+):
+    """Create the polarization correction array
+
+    Parameters
+    ----------
+    geo : pyFAI.geometry.Geometry instance
+        The calibrated geometry
+    img_shape : tuple
+        The shape of the image
+    polarization_factor : float, optional
+        The polarization factor, if None the array is all ones. Defaults
+        to .99
+    disk_cache : bool, optional
+        If False the angle terms are not loaded from or stored in
+        ``xpdtools.cache.geometry_cache``, eg for geometries which are only
+        used once. Defaults to True.
+
+    Returns
+    -------
+    ndarray :
+        The (read only, float32) polarization array, images are divided by
+        it to correct them
+
+    Notes
+    -----
+    The arrays are kept in ``xpdtools.cache.memory_cache``. They are
+    computed with pyFAI's formula from the cached angle terms of
+    ``generate_polarization_terms``, so a new factor or a new geometry
+    object with the same calibration doesn't go through pyFAI again.
+    They agree with ``geo.polarization`` to a relative tolerance of 1e-6,
+    pyFAI's own float32 result changes by a few 1e-7 depending on whether
+    it has already built its angle arrays.
     """
+    key = (
+        "polarization",
+        cache.geometry_fingerprint(geo, img_shape),
+        polarization_factor,
+    )
+    return cache.memory_cache.cached_call(
+        key,
+        _generate_polarization,
+        geo,
+        img_shape,
+        polarization_factor,
+        disk_cache,
+    )
+
+
+def _generate_polarization(geo, img_shape, polarization_factor, disk_cache):
+    if polarization_factor is None:
+        return _read_only(np.ones(img_shape, dtype=np.float32))
+    cos2_tth, cos_2chi = generate_polarization_terms(
+        geo, img_shape, disk_cache
+    )
+    pol = 1. - cos2_tth
+    pol *= cos_2chi
+    pol *= -float(polarization_factor)
+    pol += cos2_tth
+    pol += 1.
+    pol *= .5
+    return _read_only(pol.astype(np.float32))
+
+
+def generate_polarization_terms(geo, img_shape, disk_cache=True):
+    """Create the angle terms of the polarization correction
 
-    return map_to_binner(*generate_map_bin(geo, img_shape), mask=mask)
+    Parameters
+    ----------
+    geo : pyFAI.geometry.Geometry instance
+        The calibrated geometry
+    img_shape : tuple
+        The shape of the image
+    disk_cache : bool, optional
+        If False the results are not loaded from or stored in
+        ``xpdtools.cache.geometry_cache``, eg for geometries which are only
+        used once. Defaults to True.
 
+    Returns
+    -------
+    cos2_tth : ndarray
+        The square of the cosine of the scattering angle of each pixel
+    cos_2chi : ndarray
+        The cosine of twice the azimuthal angle of each pixel
+
+    Notes
+    -----
+    The (read only) results are kept in ``xpdtools.cache.memory_cache`` and
+    stored in ``xpdtools.cache.geometry_cache`` so they are loaded back
+    (memory mapped) for the same geometry and shape.
+    """
+    key = cache.geometry_fingerprint(geo, img_shape)
+    return cache.memory_cache.cached_call(
+        ("polarization_terms", key),
+        _generate_polarization_terms,
+        geo,
+        img_shape,
+        key,
+        _geometry_disk_cache(disk_cache),
+    )
+
+
+def _generate_polarization_terms(geo, img_shape, key, disk):
+    cached = disk.get(key, ("cos2_tth", "cos_2chi"))
+    if cached is not None:
+        return cached["cos2_tth"], cached["cos_2chi"]
+    with _release_arrays(geo):
+        cos2_tth = np.cos(geo.twoThetaArray(img_shape)) ** 2
+        cos_2chi = np.cos(2. * geo.chiArray(img_shape))
+    disk.put(key, cos2_tth=cos2_tth, cos_2chi=cos_2chi)
+    return _read_only(cos2_tth), _read_only(cos_2chi)
+
+
+def _read_only(a):
+    """Get a read only view of an array, so it can be shared between
+    pipelines"""
+    a = a.view()
+    a.setflags(write=False)
+    return a
+
+
+@contextmanager
+def _release_arrays(geo):
+    """Drop the arrays pyFAI caches on the geometry while deriving ours,
+    we keep our own results so they would only double the memory"""
+    arrays = getattr(geo, "_cached_array", None)
+    before = set(arrays) if isinstance(arrays, dict) else set()
+    try:
+        yield
+    finally:
+        if isinstance(arrays, dict):
+            for k in set(arrays) - before:
+                arrays.pop(k, None)
 
-def z_score_image(img, binner):
+
+def binned_statistics(img, binner, percentiles=None):
+    """Compute the mean, median, standard deviation, count and percentiles
+    of each bin from a single sorted pass over the image
+
+    Parameters
+    ----------
+    img : ndarray
+        The image
+    binner : BinnedStatistic1D or RingIndex instance
+        The binner
+    percentiles : sequence of float, optional
+        The percentiles (in [0, 100]) to compute, if None none are computed.
+        Defaults to None.
+
+    Returns
+    -------
+    dict :
+        The statistics by name ('mean', 'median', 'std', 'count' and
+        'percentiles'), with the same shape and empty bin values as
+        ``binner(img, statistic)``. The percentiles are shaped
+        (number of percentiles, number of bins).
+    """
+    n_bins = binner.nbin[0]
+    flatcount = binner.flatcount[:n_bins]
+    counts = np.zeros(n_bins - 2, dtype=np.int64)
+    counts[: len(flatcount) - 1] = flatcount[1 : n_bins - 1]
+    # only gather the pixels of the bins which are returned
+    start = flatcount[0]
+    vfs = np.ravel(img)[binner.argsort_index[start : start + counts.sum()]]
+    if percentiles is None:
+        percentiles = ()
+    mean, median, std, pct = ring_stats(
+        vfs, counts, np.asarray(percentiles, dtype=float)
+    )
+    return dict(
+        mean=mean,
+        median=median,
+        std=std,
+        count=counts.astype(float),
+        percentiles=pct,
+    )
+
+
+def z_score_image(img, binner, stats=None, out=None, dtype=np.float64):
     """Z score an image according to the azimuthal average
 
     Parameters
     ----------
     img : ndarray
         The image
-    binner : BinnedStatistic1D instance
+    binner : BinnedStatistic1D or RingIndex instance
         The binner
+    stats : dict, optional
+        The 'mean' and 'std' of each bin, as returned by
+        ``binned_statistics(img, binner)``, if None they are computed.
+        Defaults to None.
+    out : ndarray, optional
+        The array to write the z score into, it must be contiguous and have
+        the shape of the image. Defaults to None.
+    dtype : np.dtype, optional
+        The dtype of the output, if ``out`` is not given.
+        Defaults to ``np.float64``.
+
     Returns
     -------
     ndarray :
         The z scored image
     """
-    try:
-        idx = binner.argsort_index
-    except AttributeError:
-        idx = binner.xy.argsort()
-
-    vfs = img.flatten()[idx]
-
-    # TODO: parallelize/numbafy?
-    # TODO: use integrated data
+    values = np.ravel(img)
+    xy = getattr(binner, "xy", None)
+    if xy is None:
+        xy = binner.bin_index
+    flatcount = binner.flatcount
+    n_bins = len(flatcount)
     p_err = np.seterr(all="ignore")
-    i = 0
-    t = []
-    for k in binner.flatcount:
-        if k > 0:
-            t.append(vfs[i : i + k])
-        i += k
-    list(map(ring_zscore, t))
+    if stats is None:
+        mean, std = bin_moments(values, xy, n_bins)
+    else:
+        # the stats don't cover the outlier bins at either end
+        n_core = min(n_bins, len(stats["mean"]) + 1)
+        mean = np.empty(n_bins)
+        std = np.empty(n_bins)
+        mean[1:n_core] = stats["mean"][: n_core - 1]
+        std[1:n_core] = stats["std"][: n_core - 1]
+        offsets = np.zeros(n_bins + 1, dtype=np.int64)
+        np.cumsum(flatcount, out=offsets[1:])
+        for j in [0] + list(range(n_core, n_bins)):
+            v = values[binner.argsort_index[offsets[j] : offsets[j + 1]]]
+            mean[j] = np.mean(v)
+            std[j] = np.std(v)
+    inv_std = 1 / std
+
+    if out is None:
+        out = np.empty(np.shape(img), dtype=dtype)
+    elif not out.flags.c_contiguous:
+        raise ValueError("out must be a contiguous array")
+    flat_out = out.reshape(-1)
+    bin_zscore(values, xy, mean, inv_std, flat_out)
     np.seterr(**p_err)
-    img2 = np.empty(np.shape(vfs))
-    img2[idx] = vfs
-    img2 = np.nan_to_num(img2)
+    np.nan_to_num(flat_out, copy=False)
+    return out
+
+
+def correct_image(
+    fg,
+    fg_dark=None,
+    bg=None,
+    bg_dark=None,
+    bg_scale=1.,
+    polarization=None,
+    out=None,
+    dtype=np.float64,
+):
+    """Dark subtract, background subtract and polarization correct an image
+    in a single pass
+
+    This computes ``((fg - fg_dark) - (bg - bg_dark) * bg_scale) /
+    polarization`` without any full frame temporaries.
 
-    return img2.reshape(np.shape(img))
+    Parameters
+    ----------
+    fg : ndarray
+        The foreground image
+    fg_dark : ndarray, optional
+        The foreground dark, if None no dark is subtracted. Defaults to None.
+    bg : ndarray, optional
+        The background image, if None no background is subtracted.
+        Defaults to None.
+    bg_dark : ndarray, optional
+        The background dark, if None no dark is subtracted from the
+        background. Defaults to None.
+    bg_scale : float, optional
+        The background scale. Defaults to 1.
+    polarization : ndarray, optional
+        The polarization array, eg. from ``generate_polarization``, if None
+        no polarization correction is applied. Defaults to None.
+    out : ndarray, optional
+        The array to write the corrected image into, it must be contiguous
+        and have the shape of the image. Defaults to None.
+    dtype : np.dtype, optional
+        The dtype of the output, if ``out`` is not given.
+        Defaults to ``np.float64``.
+
+    Returns
+    -------
+    ndarray :
+        The corrected image
+    """
+    shape = np.shape(fg)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif not out.flags.c_contiguous:
+        raise ValueError("out must be a contiguous array")
+
+    def flat(a):
+        if a is None:
+            return None
+        # scalars and other broadcastable inputs are expanded
+        return np.ravel(np.broadcast_to(a, shape))
+
+    correct_pixels(
+        flat(fg),
+        flat(fg_dark),
+        flat(bg),
+        flat(bg_dark),
+        float(bg_scale),
+        flat(polarization),
+        out.reshape(-1),
+    )
+    return out
 
 
 def polarization_correction(img, geo, polarization_factor=.99):
@@ -342,7 +787,18 @@ def load_geo(cal_params):
     -------
     AzimuthalIntegrator :
         The calibrate azimuthal integrator (which inherits from the geometry)
+
+    Notes
+    -----
+    The integrators are kept in ``xpdtools.cache.memory_cache`` so the same
+    calibration parameters give back the same integrator.
     """
+    return cache.memory_cache.cached_call(
+        ("geometry", cache.fingerprint(cal_params)), _load_geo, cal_params
+    )
+
+
+def _load_geo(cal_params):
     from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
 
     ai = AzimuthalIntegrator()
@@ -357,6 +813,51 @@ def overlay_mask(img, mask):
     return img2
 
 
+def save_mask(filename, mask, pack=False):
+    """Save a mask
+
+    Parameters
+    ----------
+    filename : str
+        The file, a ``.npy`` file or if ``pack`` a ``.npz`` file
+    mask : np.ndarray
+        The mask
+    pack : bool, optional
+        If True store the mask with 8 pixels per byte, with its shape.
+        Defaults to False.
+    """
+    if pack:
+        np.savez(filename, bits=np.packbits(mask), shape=np.shape(mask))
+    else:
+        np.save(filename, mask)
+
+
+def load_mask(filename):
+    """Load a mask written by ``save_mask`` or the fit2d mask written by
+    the ``process_tiff`` CLI
+
+    Parameters
+    ----------
+    filename : str
+        The ``.npy``, ``.npz`` or ``.msk`` file
+
+    Returns
+    -------
+    np.ndarray :
+        The mask
+    """
+    if filename.endswith(".msk"):
+        # the CLI writes fit2d masks upside down
+        return np.flipud(read_fit2d_msk(filename))
+    data = np.load(filename)
+    if not isinstance(data, np.ndarray):
+        with data:
+            shape = tuple(data["shape"])
+            bits = np.unpackbits(data["bits"], count=int(np.prod(shape)))
+        return bits.reshape(shape).astype(bool)
+    return data
+
+
 def pdf_getter(x, y, composition, **kwargs):
     """Process the data to the PDF
 
@@ -449,6 +950,118 @@ def sq_getter(x, y, composition, **kwargs):
     return res[0], res[1], pg.config
 
 
+def sq_fq_pdf_getter(x, y, composition, fq_kwargs=None, pdf_kwargs=None):
+    """Process the data to S(Q), F(Q) and the PDF with as few PDFGetter
+    runs as possible
+
+    The PDF is computed with ``pdf_kwargs``. S(Q) and F(Q) come from the
+    same run if ``fq_kwargs`` only differs by a lower (or equal) ``qmax``,
+    since they are then the truncation of the PDF run's S(Q) and F(Q),
+    otherwise they come from a second run with ``fq_kwargs``.
+
+    Parameters
+    ----------
+    x : ndarray
+        The q or tth values
+    y : ndarray
+        The scattered intensity
+    composition : str
+        The composition
+    fq_kwargs : dict, optional
+        Additional kwargs for PDFGetter for S(Q) and F(Q), if None use
+        ``pdf_kwargs``. Defaults to None.
+    pdf_kwargs : dict, optional
+        Additional kwargs for PDFGetter for the PDF. Defaults to None.
+
+    Returns
+    -------
+    sq : tuple
+        The q, S(Q) and config, as returned by ``sq_getter``
+    fq : tuple
+        The q, F(Q) and config, as returned by ``fq_getter``
+    pdf : tuple
+        The r, G(r) and config, as returned by ``pdf_getter``
+    """
+    pdf_kwargs = dict(pdf_kwargs or {}, composition=composition)
+    if fq_kwargs is None:
+        fq_kwargs = pdf_kwargs
+    fq_kwargs = dict(fq_kwargs, composition=composition)
+
+    pg = PDFGetter()
+    r, gr = pg(x, y, **pdf_kwargs)
+    pdf = r, gr, pg.config
+
+    fq_qmax = fq_kwargs.pop("qmax", None)
+    pdf_qmax = pdf_kwargs.pop("qmax", None)
+    if fq_kwargs == pdf_kwargs and fq_qmax == pdf_qmax:
+        return (
+            (pg.sq[0], pg.sq[1], pg.config),
+            (pg.fq[0], pg.fq[1], pg.config),
+            pdf,
+        )
+    # a lower F(Q) qmax is a cut of the same F(Q)
+    same_run = fq_kwargs == pdf_kwargs and None not in (fq_qmax, pdf_qmax)
+    if same_run and fq_qmax <= pdf_qmax:
+        config = copy.copy(pg.config)
+        try:
+            config.qmax = fq_qmax
+        except AttributeError:
+            config["qmax"] = fq_qmax
+        return tuple(
+            (res[0][res[0] <= fq_qmax], res[1][res[0] <= fq_qmax], config)
+            for res in (pg.sq, pg.fq)
+        ) + (pdf,)
+
+    if fq_qmax is not None:
+        fq_kwargs["qmax"] = fq_qmax
+    pg = PDFGetter()
+    pg(x, y, **fq_kwargs)
+    return (
+        (pg.sq[0], pg.sq[1], pg.config),
+        (pg.fq[0], pg.fq[1], pg.config),
+        pdf,
+    )
+
+
+def cached_sq_fq_pdf_getter(
+    x, y, composition, fq_kwargs=None, pdf_kwargs=None
+):
+    """``sq_fq_pdf_getter`` with the results kept in
+    ``xpdtools.cache.pdf_cache``, so unchanged inputs return immediately
+
+    Parameters
+    ----------
+    x : ndarray
+        The q or tth values
+    y : ndarray
+        The scattered intensity
+    composition : str
+        The composition
+    fq_kwargs : dict, optional
+        Additional kwargs for PDFGetter for S(Q) and F(Q), if None use
+        ``pdf_kwargs``. Defaults to None.
+    pdf_kwargs : dict, optional
+        Additional kwargs for PDFGetter for the PDF. Defaults to None.
+
+    Returns
+    -------
+    sq : tuple
+        The q, S(Q) and config, as returned by ``sq_getter``
+    fq : tuple
+        The q, F(Q) and config, as returned by ``fq_getter``
+    pdf : tuple
+        The r, G(r) and config, as returned by ``pdf_getter``
+    """
+    return cache.pdf_cache.cached_call(
+        sq_fq_pdf_getter,
+        np.asarray(x),
+        np.asarray(y),
+        composition,
+        fq_kwargs=fq_kwargs,
+        pdf_kwargs=pdf_kwargs,
+    )
+
+
 def nu_fq_getter(q, iq, composition, **kwargs):
     """Process the data to F(Q) on a non uniform grid
 
@@ -484,7 +1097,7 @@ def nu_fq_getter(q, iq, composition, **kwargs):
     return res[0], res[1], pg.config
 
 
-def nu_pdf_getter(q, fq):
+def nu_pdf_getter(q, fq, max_bytes=None):
     """Process a non uniform F(Q) to the PDF
 
     Parameters
@@ -492,21 +1105,164 @@ def nu_pdf_getter(q, fq):
     q : ndarray
         The q or tth values
     fq : ndarray
-        The reduced structure funciton
+        The reduced structure funciton, or a stack of them shaped
+        (number of patterns, len(q)) which are transformed in one matrix
+        product
+    max_bytes : int, optional
+        The memory the transform may use for its sine table. If the table
+        fits it is cached for the q grid, otherwise it is computed in
+        blocks of r for every call. If None 64 MB. Defaults to None.
 
     Returns
     -------
     r : ndarray
         The radial values
     gr: ndarray
-        The PDF
+        The PDF, shaped like ``fq``
     """
+    if max_bytes is None:
+        max_bytes = 64 * 1024 ** 2
     rgrid = np.arange(0, 30.01, np.pi / np.max(q))
-    dgr = 2 / np.pi * fq * np.sin(q * rgrid[:, np.newaxis])
-    gr = simps(dgr, q)
+    table_bytes = len(rgrid) * len(q) * 8
+    if table_bytes <= max_bytes:
+        key = ("sine_table", cache.array_fingerprint(q, rgrid))
+        table = cache.memory_cache.cached_call(
+            key, _sine_table, q, rgrid, max_bytes
+        )
+        return rgrid, np.dot(fq, table.T)
+    gr = np.empty(np.shape(fq)[:-1] + rgrid.shape)
+    step = max(1, max_bytes // (len(q) * 8))
+    for i in range(0, len(rgrid), step):
+        gr[..., i : i + step] = np.dot(
+            fq, _sine_table(q, rgrid[i : i + step], max_bytes).T
+        )
     return rgrid, gr
 
 
+def _sine_table(q, rgrid, max_bytes):
+    """The (len(rgrid), len(q)) matrix taking F(Q) to G(r), with the Simpson
+    weights folded in"""
+    w = cache.memory_cache.cached_call(
+        ("simpson_weights", cache.array_fingerprint(q)),
+        _simpson_weights,
+        q,
+        max_bytes,
+    )
+    table = np.sin(q * rgrid[:, np.newaxis])
+    table *= 2 / np.pi * w
+    return _read_only(table)
+
+
+def _simpson_weights(x, max_bytes):
+    """The weights which make ``np.dot(w, y) == simps(y, x)``"""
+    # simps is linear in y, so the weights are the integrals of the unit
+    # vectors, taken in blocks to bound the memory
+    n = len(x)
+    w = np.empty(n)
+    step = max(1, max_bytes // (n * 8))
+    for i in range(0, n, step):
+        rows = np.arange(i, min(i + step, n))
+        unit = np.zeros((len(rows), n))
+        unit[np.arange(len(rows)), rows] = 1
+        w[rows] = simps(unit, x)
+    return _read_only(w)
+
+
+def batch_pdf_getter(
+    x,
+    ys,
+    composition,
+    non_uniform=False,
+    max_workers=None,
+    pool=None,
+    **kwargs
+):
+    """Process a stack of patterns on the same grid to F(Q) and the PDF
+
+    Each worker configures one PDFGetter and runs it over a block of the
+    patterns.
+
+    Parameters
+    ----------
+    x : ndarray
+        The q or tth values
+    ys : ndarray
+        The scattered intensities, shaped (number of patterns, len(x))
+    composition : str
+        The composition
+    non_uniform : bool, optional
+        If True process the patterns as ``nu_fq_getter`` and
+        ``nu_pdf_getter`` do, for non uniform grids. Defaults to False.
+    max_workers : int, optional
+        The number of processes, if 1 the patterns are processed in this
+        process. If None use the number of CPUs. Defaults to None.
+    pool : Executor, optional
+        The pool to run the blocks of patterns on, if None a process pool
+        with ``max_workers`` processes is used. Defaults to None.
+    kwargs: dict
+        Additional kwargs for PDFGetter
+
+    Returns
+    -------
+    r : ndarray
+        The radial values
+    gr : ndarray
+        The PDFs, shaped (number of patterns, len(r))
+    q : ndarray
+        The q values of F(Q)
+    fq : ndarray
+        The reduced structure functions, shaped (number of patterns, len(q))
+    config: dict
+        The PDFGetter config
+    """
+    ys = np.atleast_2d(ys)
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    if pool is None and (max_workers == 1 or len(ys) == 1):
+        return _batch_pdf_getter(x, ys, composition, non_uniform, kwargs)
+    blocks = np.array_split(ys, min(len(ys), 4 * max_workers))
+    args = (repeat(x), blocks, repeat(composition), repeat(non_uniform))
+    if pool is None:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(_batch_pdf_getter, *args, repeat(kwargs)))
+    else:
+        results = list(pool.map(_batch_pdf_getter, *args, repeat(kwargs)))
+    r, _, q, _, config = results[0]
+    return (
+        r,
+        np.concatenate([res[1] for res in results]),
+        q,
+        np.concatenate([res[3] for res in results]),
+        config,
+    )
+
+
+def _batch_pdf_getter(x, ys, composition, non_uniform, kwargs):
+    """Run one PDFGetter over a block of patterns"""
+    kwargs = dict(kwargs, composition=composition)
+    pg = PDFGetter()
+    if non_uniform:
+        # explicit qmin/qmaxinst cutting
+        keep = (kwargs["qmaxinst"] > x) & (x > kwargs["qmin"])
+        x = x[keep]
+        ys = ys[:, keep]
+        # remove resampling transformations (and bg sub)
+        for t in [7, 6, 1]:
+            pg.transformations.pop(t)
+    grs = []
+    fqs = []
+    for i, y in enumerate(ys):
+        # the chain is configured by the first call and reused afterwards
+        r, gr = pg(x, y, **kwargs) if i == 0 else pg(x, y)
+        grs.append(gr)
+        fqs.append(pg.fq[1])
+    q = pg.fq[0]
+    fqs = np.asarray(fqs)
+    if non_uniform:
+        r, grs = nu_pdf_getter(q, fqs)
+    return r, np.asarray(grs), q, fqs, pg.config
+
+
 def move_center(motors, geometry):
     """Move the PONI for pyFAI based off of a diffx/diffy motor move
 
@@ -0,0 +1,158 @@
+"""Write results on a background thread so the processing does not wait on
+the file system"""
+##############################################################################
+#
+# xpdtools            by Billinge Group
+#                   Simon J. L. Billinge sb2896@columbia.edu
+#                   (c) 2017 trustees of Columbia University in the City of
+#                        New York.
+#                   All rights reserved
+#
+# File coded by:    Christopher J. Wright
+#
+# See AUTHORS.txt for a list of people who contributed.
+# See LICENSE.txt for license information.
+#
+##############################################################################
+import queue
+import threading
+import time
+
+_stop = object()
+
+
+class AsyncWriter(object):
+    """Run writes, in order, on a background thread
+
+    The writes are handed over through a bounded queue, when it is full
+    ``submit`` blocks until there is room so no result is dropped. The first
+    error in a write is raised by the next ``submit`` or by ``close``.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The number of writes which can wait in the queue. Defaults to 16.
+
+    Attributes
+    ----------
+    written : int
+        The number of writes done
+    max_depth : int
+        The largest number of writes waiting in the queue
+    total_latency : float
+        The time spent in the writes, in seconds
+    max_latency : float
+        The longest write, in seconds
+    """
+
+    def __init__(self, maxsize=16):
+        self.queue = queue.Queue(maxsize)
+        self.written = 0
+        self.max_depth = 0
+        self.total_latency = 0.
+        self.max_latency = 0.
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _stop:
+                break
+            func, args, kwargs = item
+            t0 = time.monotonic()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                # keep the first error, the later writes still run
+                if self.error is None:
+                    self.error = e
+            latency = time.monotonic() - t0
+            self.written += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    @property
+    def depth(self):
+        """The number of writes waiting in the queue"""
+        return self.queue.qsize()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a write
+
+        Parameters
+        ----------
+        func : callable
+            The write
+        args, kwargs :
+            The arguments of the write
+        """
+        if self.closed:
+            raise RuntimeError("The writer is closed")
+        self._raise()
+        self.queue.put((func, args, kwargs))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def wrap(self, func):
+        """Make a function which queues calls to ``func``
+
+        Parameters
+        ----------
+        func : callable
+            The write
+
+        Returns
+        -------
+        callable :
+            Queues a call to ``func`` with its arguments
+        """
+
+        def queued(*args, **kwargs):
+            self.submit(func, *args, **kwargs)
+
+        return queued
+
+    def stats(self):
+        """The statistics of the writes
+
+        Returns
+        -------
+        dict :
+            The number of writes, the current and largest queue depth and the
+            mean and largest write latency
+        """
+        return dict(
+            written=self.written,
+            depth=self.depth,
+            max_depth=self.max_depth,
+            mean_latency=self.total_latency / max(self.written, 1),
+            max_latency=self.max_latency,
+        )
+
+    def close(self):
+        """Finish the queued writes and stop the thread
+
+        Returns
+        -------
+        dict :
+            The statistics of the writes, see ``stats``
+        """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(_stop)
+            self.thread.join()
+        self._raise()
+        return self.stats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()